@@ -0,0 +1,199 @@
+#######################################################################################
+#
+# MODULE:       bench
+# AUTHOR(S):    David Pairman <pairmand landcareresearch.co.nz>
+# PURPOSE:      Reproducible stage benchmark of v.extendline's engine
+# COPYRIGHT:    (C) 2015 Landcare Research New Zealand Ltd
+#
+#               This program is free software under the GNU General Public
+#               License (version 3). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#######################################################################################
+"""
+Times each stage of the extension pipeline that v.extendline runs with
+method=engine (dangles, search, resolve, further passes, new ends and,
+with --snap, snapping) on synthetic paddock networks at several scales.
+GRASS is not needed; reading and writing maps is left out.
+
+Each scale runs in a fresh process, so its peak memory is its own. The
+results, with the stage records of extendprof and a checksum of the
+extensions made, are written to a JSON baseline (--out). --compare checks a
+run against an earlier baseline: a changed checksum always fails, and with
+--fail-slower so does a total time or peak memory beyond --tolerance times
+the baseline's.
+
+    python benchmark/bench.py --scales 10000,100000,1000000 --out base.json
+    python benchmark/bench.py --scales 10000,100000,1000000 --compare base.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import extendlib
+import extendprof
+from paddocks import paddocks
+
+# Generator settings, recorded with each run so baselines stay comparable
+NETWORK = ('cell', 'jitter', 'dangles', 'gap', 'gap_sigma', 'crossing', 'stubs', 'seed')
+# Extension settings, likewise
+EXTEND = ('maxlen', 'scale', 'passes', 'nprocs', 'snap')
+
+
+def checksum(dangles, best, x, y, snapped=None):
+    """SHA-256 of the extensions made: each dangle's line, end, intersect type
+    and other, and its new end rounded to 1e-6 (plus snapped lines)."""
+    h = hashlib.sha256()
+    for a in (dangles['line'], dangles['dend'], best['xtype'], best['other'],
+              np.round(x, 6), np.round(y, 6)):
+        h.update(np.ascontiguousarray(a).tobytes())
+    if snapped is not None:
+        changed, coords = snapped
+        h.update(np.ascontiguousarray(changed).tobytes())
+        for parts in coords:
+            for c in parts:
+                h.update(np.round(c, 6).tobytes())
+    return h.hexdigest()
+
+
+def run_scale(lines, settings):
+    """Generate about lines lines and extend them, returning the run record.
+    counts holds the number of each intersect type made and of the jilted,
+    those whose first choice, an extension, chose something else."""
+    prof = extendprof.Profiler()
+    with prof.stage('generate') as rec:
+        xy, offsets = paddocks(lines, **dict((k, settings[k]) for k in NETWORK))
+        rec['items'], rec['unit'] = len(offsets) - 1, 'lines'
+    line = np.arange(1, len(offsets), dtype=np.int64)
+    dangles, length, best = extendlib.extend_tiled(xy, offsets, line, line, None, settings['maxlen'],
+                                                   settings['scale'], 1, settings['nprocs'], prof)
+    passes = extendlib.extend_passes(dangles, length, best, settings['passes'], prof=prof)
+    with prof.stage('new_ends', len(dangles), 'dangles'):
+        x = dangles['x'].copy()
+        y = dangles['y'].copy()
+        mods, nx, ny = extendlib.new_ends(dangles, best)
+        x[mods] = nx
+        y[mods] = ny
+    snapped = None
+    if settings['snap']:
+        with prof.stage('snap', len(dangles), 'dangles'):
+            snapped = extendlib.snap_lines(xy, offsets, line, line, dangles, best)
+    total = sum(rec['wall'] for rec in prof.stages if rec['stage'] != 'generate')
+    peak = extendprof._peak_rss()
+# Jilted extensions, from a search of the whole network left out of the times
+    d, length, cand = extendlib.search_candidates(xy, offsets, line, line, None, settings['maxlen'],
+                                                  settings['scale'])
+    counts = dict((name, int((best['xtype'] == k).sum())) for k, name in enumerate(extendlib.XTYPES))
+    counts['jilted'] = len(extendlib.jilted(cand, len(d)))
+    return {'lines': len(offsets) - 1,
+            'vertices': len(xy),
+            'dangles': len(dangles),
+            'passes': passes,
+            'counts': counts,
+            'checksum': checksum(dangles, best, x, y, snapped),
+            'wall': total,
+            'peak_rss_mb': peak,
+            'stages': prof.stages}
+
+
+def compare(runs, baseline, tolerance, fail_slower):
+    """Print each run against the baseline run of the same size, returning
+    the number of failures."""
+    old = dict((run['lines'], run) for run in baseline['runs'])
+    failed = 0
+    print("{:>10} {:>10} {:>10} {:>8} {:>10} {:>10}  {}".format(
+        'lines', 'wall (s)', 'base (s)', 'ratio', 'rss (MB)', 'base (MB)', 'result'))
+    for run in runs:
+        base = old.get(run['lines'])
+        if base is None:
+            print("{:>10} {:>10.3f} {:>10}".format(run['lines'], run['wall'], 'none'))
+            continue
+        ratio = run['wall'] / base['wall'] if base['wall'] > 0 else float('inf')
+        notes = []
+        if ratio > tolerance:
+            notes.append('slower')
+        if run['peak_rss_mb'] > base['peak_rss_mb'] * tolerance:
+            notes.append('more memory')
+        if notes and fail_slower:
+            failed += 1
+        if run['checksum'] != base['checksum']:
+            notes.insert(0, 'CHANGED RESULT')
+            failed += 1
+        print("{:>10} {:>10.3f} {:>10.3f} {:>8.2f} {:>10.1f} {:>10.1f}  {}".format(
+            run['lines'], run['wall'], base['wall'], ratio, run['peak_rss_mb'], base['peak_rss_mb'],
+            ', '.join(notes) or 'ok'))
+        stages = dict((rec['stage'], rec['wall']) for rec in base['stages'])
+        for rec in run['stages']:
+            if rec['stage'] in stages and stages[rec['stage']] > 0:
+                print("{:>10} {:>10.3f} {:>10.3f} {:>8.2f}  {}".format(
+                    '', rec['wall'], stages[rec['stage']], rec['wall'] / stages[rec['stage']], rec['stage']))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='10000,100000,1000000',
+                        help="comma separated numbers of lines to run (def=10000,100000,1000000)")
+    parser.add_argument('--out', help="JSON file to write the results to, as a baseline")
+    parser.add_argument('--compare', help="JSON baseline to compare the results with")
+    parser.add_argument('--tolerance', type=float, default=1.2,
+                        help="ratio to the baseline's time or memory counted as worse (def=1.2)")
+    parser.add_argument('--fail-slower', action='store_true',
+                        help="fail when worse than the baseline by more than the tolerance, not just on changed results")
+    parser.add_argument('--maxlen', type=float, default=200)
+    parser.add_argument('--scale', type=float, default=0.5)
+    parser.add_argument('--passes', type=int, default=1)
+    parser.add_argument('--nprocs', type=int, default=1)
+    parser.add_argument('--snap', action='store_true', help="also time snapping (v.extendline -n)")
+    parser.add_argument('--cell', type=float, default=200.0)
+    parser.add_argument('--jitter', type=float, default=15.0)
+    parser.add_argument('--dangles', type=float, default=0.2)
+    parser.add_argument('--gap', type=float, default=20.0)
+    parser.add_argument('--gap-sigma', type=float, default=1.0)
+    parser.add_argument('--crossing', type=float, default=0.05)
+    parser.add_argument('--stubs', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--one', type=int, help=argparse.SUPPRESS)   # Run one scale, JSON to stdout
+    args = parser.parse_args()
+    settings = dict((k, getattr(args, k)) for k in NETWORK + EXTEND)
+
+    if args.one is not None:
+        json.dump(run_scale(args.one, settings), sys.stdout)
+        return 0
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        if baseline['meta']['settings'] != settings:
+            print("Warning: baseline settings differ: {}".format(baseline['meta']['settings']), file=sys.stderr)
+    runs = []
+    for lines in [int(v) for v in args.scales.split(',')]:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--one', str(lines)] + sys.argv[1:],
+                             stdout=subprocess.PIPE, check=True).stdout
+        run = json.loads(out)
+        runs.append(run)
+        print("{} lines: {} dangles {}, {:.3f}s, {:.1f} MB".format(
+            run['lines'], run['dangles'], run['counts'], run['wall'], run['peak_rss_mb']), file=sys.stderr)
+    meta = {'settings': settings,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'node': platform.node(),
+            'cpus': os.cpu_count()}
+    if args.out:
+        with open(args.out, 'w') as fh:
+            json.dump({'meta': meta, 'runs': runs}, fh, indent=2)
+    if args.compare:
+        return 1 if compare(runs, baseline, args.tolerance, args.fail_slower) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+#######################################################################################
+#
+# MODULE:       paddocks
+# AUTHOR(S):    David Pairman <pairmand landcareresearch.co.nz>
+# PURPOSE:      Synthetic paddock-boundary networks for benchmarking v.extendline
+# COPYRIGHT:    (C) 2015 Landcare Research New Zealand Ltd
+#
+#               This program is free software under the GNU General Public
+#               License (version 3). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#######################################################################################
+"""
+Synthetic field-boundary networks, like the segmented paddock boundaries
+v.extendline is used on, generated straight into extendlib's packed line
+arrays so millions of lines take seconds.
+
+A jittered grid of paddocks has each boundary edge between two grid nodes as
+a three-vertex line. Edges are cut back from their nodes to make dangles
+that reach the edges still at the node ('orig'), crossroads have every edge
+cut back so the extensions cross each other ('ext', and jilted where more
+than two meet; cut ends are offset a little sideways, so the extensions
+do not all meet exactly at the node), and short stubs inside paddocks mostly reach nothing
+('null'). The same arguments always give the same lines.
+"""
+import numpy as np
+
+
+def paddocks(lines=10000, cell=200.0, jitter=15.0, dangles=0.2, gap=20.0, gap_sigma=1.0,
+             crossing=0.05, stubs=0.1, seed=0):
+    """About lines lines of a paddock network, packed as (xy, offsets).
+
+    cell is the paddock size and jitter the standard deviation of the grid
+    nodes' offsets. dangles is the fraction of edges with one end cut back
+    from its node, by a lognormal gap with median gap and shape gap_sigma;
+    long gaps leave the dangle out of reach ('null'). crossing is the
+    fraction of inner nodes with all four edges cut back, and stubs the
+    number of short loose lines per paddock. Lines come in random order.
+    """
+    rng = np.random.default_rng(seed)
+    n = max(1, int(round(np.sqrt(lines / (2.0 + stubs)))))
+    rows, cols = np.divmod(np.arange((n + 1) ** 2), n + 1)
+    nodes = np.column_stack([cols * cell, rows * cell]) + rng.normal(0, jitter, ((n + 1) ** 2, 2))
+
+# Edges between neighbouring nodes, horizontal then vertical
+    r, c = np.meshgrid(np.arange(n + 1), np.arange(n), indexing='ij')
+    a = [(r * (n + 1) + c).ravel()]
+    b = [(r * (n + 1) + c + 1).ravel()]
+    r, c = np.meshgrid(np.arange(n), np.arange(n + 1), indexing='ij')
+    a.append((r * (n + 1) + c).ravel())
+    b.append(((r + 1) * (n + 1) + c).ravel())
+    a = np.concatenate(a)
+    b = np.concatenate(b)
+    mid = (nodes[a] + nodes[b]) / 2 + rng.normal(0, jitter / 3, (len(a), 2))
+
+# Dangles: one end of some edges cut back
+    trim_a = np.zeros(len(a))
+    trim_b = np.zeros(len(a))
+    cut = rng.random(len(a)) < dangles
+    at_a = rng.random(len(a)) < 0.5
+    g = gap * np.exp(gap_sigma * rng.standard_normal(len(a)))
+    trim_a[cut & at_a] = g[cut & at_a]
+    trim_b[cut & ~at_a] = g[cut & ~at_a]
+# Crossroads: every edge at some inner nodes cut back
+    inner = (rows > 0) & (rows < n) & (cols > 0) & (cols < n)
+    cross = inner & (rng.random(len(nodes)) < crossing)
+    cross_gap = rng.uniform(gap / 4, gap, len(nodes))
+    trim_a = np.where(cross[a], np.maximum(trim_a, cross_gap[a]), trim_a)
+    trim_b = np.where(cross[b], np.maximum(trim_b, cross_gap[b]), trim_b)
+# Cut ends a little off the line to their node, so extensions meeting at a
+# crossroads do not all pass through the node itself
+    side = rng.normal(0, gap / 20, (2, len(a)))
+    edges = np.stack([_cut(nodes[a], mid, trim_a, side[0]), mid, _cut(nodes[b], mid, trim_b, side[1])], axis=1)
+
+# Stubs: short loose lines inside the paddocks
+    m = int(round(stubs * n * n))
+    centre = rng.uniform(0, n * cell, (m, 2))
+    half = rng.uniform(cell / 40, cell / 10, m)
+    az = rng.uniform(0, 2 * np.pi, m)
+    d = np.column_stack([np.cos(az), np.sin(az)]) * half[:, None]
+    stub = np.stack([centre - d, centre + rng.normal(0, jitter / 10, (m, 2)), centre + d], axis=1)
+
+    vertices = np.concatenate([edges, stub])[rng.permutation(len(edges) + m)]
+    xy = np.ascontiguousarray(vertices.reshape(-1, 2))
+    offsets = np.arange(0, len(xy) + 1, 3, dtype=np.int64)
+    return xy, offsets
+
+
+def _cut(end, mid, trim, side):
+    # Move end towards mid by trim, at most 0.9 of the way, and if it moved
+    # by side across the way (to the left)
+    d = mid - end
+    length = np.hypot(d[:, 0], d[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = np.where(length > 0, np.minimum(trim / length, 0.9), 0.0)
+        s = np.where((length > 0) & (f > 0), side / length, 0.0)
+    return end + d * f[:, None] + np.column_stack([-d[:, 1], d[:, 0]]) * s[:, None]
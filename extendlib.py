@@ -0,0 +1,1188 @@
+#######################################################################################
+#
+# MODULE:       extendlib
+# AUTHOR(S):    David Pairman <pairmand landcareresearch.co.nz>
+# PURPOSE:      Geometry engine for v.extendline, working on NumPy coordinate arrays
+# COPYRIGHT:    (C) 2015 Landcare Research New Zealand Ltd
+#
+#               This program is free software under the GNU General Public
+#               License (version 3). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#######################################################################################
+"""
+Core of v.extendline: dangle detection, extension, intersection search and
+resolution on NumPy coordinate arrays, with no dependency on GRASS.
+
+extend_dangles() and extend_coords() take plain per-line coordinate arrays
+(e.g. from shapely LineString.coords) and can be used outside GRASS;
+v.extendline itself is a thin adapter reading and writing GRASS maps.
+
+The intersection search replaces v.distance.
+Dangle extensions are held as rays (origin, azimuth, search length) and the
+lines they can meet as flat segment arrays (x0, y0, x1, y1). Segments are
+bucketed into a uniform grid with a cell the size of the longest search, so
+each ray only needs testing against the segments of the few cells its bounding
+box covers. Only the nearest hit per ray is kept.
+
+Lines are passed around packed as one (n, 2) vertex array xy plus offsets,
+line i running over xy[offsets[i]:offsets[i+1]].
+
+Functions taking prof record their stages on an extendprof.Profiler.
+
+build_index() bundles the packed lines with their segments and segment grid;
+save_index() and load_index() keep it on disk as memory-mapped .npy files so
+repeat runs on an unchanged map skip reading the map and building the grid.
+"""
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from extendprof import NOPROF
+
+# Intersection types, index matches the xtype text stored in the extend table
+XTYPES = ('null', 'orig', 'ext')
+NULL, ORIG, EXT = 0, 1, 2
+
+HIT_DTYPE = [('dist', 'f8'), ('x', 'f8'), ('y', 'f8'), ('cat', 'i8')]
+
+# Dangle ends, index matches the dend text stored in the extend table
+DENDS = ('head', 'tail')
+HEAD, TAIL = 0, 1
+
+# Candidate intersects of dangle extensions, and the one chosen per dangle.
+# other is the line cat for 'orig', the other dangle's index for 'ext'; xid
+# identifies the candidate's source row where there is one.
+CAND_DTYPE = [('dangle', 'i8'), ('other', 'i8'), ('xtype', 'i1'),
+              ('dist', 'f8'), ('x', 'f8'), ('y', 'f8'), ('xid', 'i8')]
+RESULT_DTYPE = [('xtype', 'i1'), ('dist', 'f8'), ('x', 'f8'), ('y', 'f8'),
+                ('other', 'i8'), ('xid', 'i8')]
+
+# Per-dangle result of extend_dangles(); (x, y) is the dangle end and
+# (ex, ey) its new end, equal to (x, y) where there is nothing to meet
+EXTENSION_DTYPE = [('line', 'i8'), ('dend', 'i1'), ('x', 'f8'), ('y', 'f8'),
+                   ('az', 'f8'), ('search_len', 'f8'), ('xtype', 'i1'),
+                   ('other', 'i8'), ('dist', 'f8'), ('ex', 'f8'), ('ey', 'f8')]
+
+# One record per dangle; line is the feature id, length the line's length
+DANGLE_DTYPE = [('line', 'i8'), ('cat', 'i8'), ('dend', 'i1'),
+                ('x', 'f8'), ('y', 'f8'), ('az', 'f8'), ('length', 'f8')]
+
+# Upper bound on ray/segment pairs tested in one vectorised block
+CHUNK = 1 << 21
+
+# Distance ends on original lines overshoot, as break lines is unreliable
+OVERSHOOT = 0.1
+
+# Arrays of a line index (see build_index()), each saved as <name>.npy
+INDEX_ARRAYS = ('xy', 'offsets', 'line', 'cat', 'is_line',
+                'x0', 'y0', 'x1', 'y1', 'owner', 'keys', 'starts', 'items')
+
+# Rough working memory per line of a tile (vertices, segments, grid, search),
+# used to size tiles to a memory budget
+LINE_BYTES = 4096
+
+
+def pack_lines(coords):
+    """Pack a list of per-line coordinate arrays into (xy, offsets)."""
+    offsets = np.zeros(len(coords) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in coords])
+    if offsets[-1] == 0:
+        return np.zeros((0, 2)), offsets
+    xy = np.concatenate([_coords(c) for c in coords])
+    return xy, offsets
+
+
+def _coords(c):
+    # A line's coordinates as an (n, 2) float array, also when it has none
+    c = np.asarray(c, dtype=np.float64)
+    return c[:, :2] if len(c) else np.zeros((0, 2))
+
+
+def line_segments(xy, offsets, select=None):
+    """Segments of packed lines as (x0, y0, x1, y1, line index) arrays.
+
+    select is an optional boolean mask of the lines to take segments from.
+    """
+    nv = np.diff(offsets)
+    ns = np.maximum(nv - 1, 0)
+    if select is not None:
+        ns = np.where(select, ns, 0)
+    owner = np.repeat(np.arange(len(nv), dtype=np.int64), ns)
+    i = np.arange(ns.sum(), dtype=np.int64) - np.repeat(np.cumsum(ns) - ns, ns)
+    i += offsets[:-1][owner]
+    return xy[i, 0], xy[i, 1], xy[i + 1, 0], xy[i + 1, 1], owner
+
+
+def line_lengths(xy, offsets):
+    """Length of each packed line."""
+    x0, y0, x1, y1, owner = line_segments(xy, offsets)
+    return np.bincount(owner, weights=np.hypot(x1 - x0, y1 - y0),
+                       minlength=len(offsets) - 1)
+
+
+def find_dangles(xy, offsets, line, cat, is_line=None, vlen=1):
+    """Find dangles from a bulk endpoint degree count.
+
+    Every end of every packed line is a node, and ends sharing exact
+    coordinates share the node. A node with only one line end is a dangle;
+    those on features flagged in is_line (all by default) are returned as
+    DANGLE_DTYPE records. The dangle azimuth looks back vlen vertices along
+    the line. line and cat are the feature id and cat of each packed line.
+    """
+    n = len(offsets) - 1
+    if n == 0:
+        return np.zeros(0, dtype=DANGLE_DTYPE)
+    first = offsets[:-1]
+    last = np.maximum(offsets[1:] - 1, first)
+    ends = np.concatenate([first, last])
+# Lines without vertices have no ends
+    live = np.flatnonzero(np.tile(offsets[1:] > first, 2))
+    ex = xy[ends[live], 0]
+    ey = xy[ends[live], 1]
+    order = np.lexsort((ey, ex))
+    sx = ex[order]
+    sy = ey[order]
+    new = np.r_[True, (sx[1:] != sx[:-1]) | (sy[1:] != sy[:-1])]
+    node = np.empty(len(live), dtype=np.int64)
+    node[order] = np.cumsum(new) - 1
+
+    dangle = np.zeros(len(ends), dtype=bool)
+    dangle[live] = np.bincount(node)[node] == 1
+    if is_line is not None:
+        dangle &= np.tile(np.asarray(is_line, dtype=bool), 2)
+    k = np.flatnonzero(dangle)
+    k = k[np.argsort(k % n * 2 + k // n, kind='stable')]  # line order, head first
+    idx = k % n
+    dend = (k >= n).astype(np.int8)
+# Vertex vlen back from the dangle end, or the other end of a short line
+    back = np.where(dend == HEAD,
+                    np.minimum(first[idx] + vlen, last[idx]),
+                    np.maximum(last[idx] - vlen, first[idx]))
+    out = np.zeros(len(k), dtype=DANGLE_DTYPE)
+    out['line'] = np.asarray(line)[idx]
+    out['cat'] = np.asarray(cat)[idx]
+    out['dend'] = dend
+    out['x'] = xy[ends[k], 0]
+    out['y'] = xy[ends[k], 1]
+    out['az'] = np.arctan2(out['y'] - xy[back, 1], out['x'] - xy[back, 0])
+    out['length'] = line_lengths(xy, offsets)[idx]
+    return out
+
+
+def search_length(length, maxlen, scale):
+    """Extension search length, the lesser of maxlen and scale * line length
+    (maxlen alone when scale is 0)."""
+    length = np.asarray(length, dtype=np.float64)
+    if scale > 0:
+        return np.minimum(length * scale, maxlen)
+    return np.full(len(length), float(maxlen))
+
+
+def build_grid(x0, y0, x1, y1, cell):
+    """Bucket segments into a uniform grid.
+
+    Returns the tuple (gx, gy, cell, ncol, keys, starts, items) where keys are
+    the occupied cell ids in ascending order and items[starts[k]:starts[k+1]]
+    are the segments touching cell keys[k].
+    """
+    x0 = np.asarray(x0, dtype=np.float64)
+    y0 = np.asarray(y0, dtype=np.float64)
+    x1 = np.asarray(x1, dtype=np.float64)
+    y1 = np.asarray(y1, dtype=np.float64)
+    cell = float(cell) if cell > 0 else 1.0
+    if len(x0) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return (0.0, 0.0, cell, 1, empty, np.zeros(1, dtype=np.int64), empty)
+    gx = min(x0.min(), x1.min())
+    gy = min(y0.min(), y1.min())
+    ncol = int((max(x0.max(), x1.max()) - gx) // cell) + 1
+# Long segments are bucketed as cell-long pieces, so a long diagonal covers
+# the cells along it rather than every cell of its bounding box
+    k = np.maximum(np.ceil(np.hypot(x1 - x0, y1 - y0) / cell), 1).astype(np.int64)
+    seg = np.repeat(np.arange(len(x0), dtype=np.int64), k)
+    j = np.arange(len(seg), dtype=np.int64) - np.repeat(np.cumsum(k) - k, k)
+    f0 = j / k[seg]
+    f1 = (j + 1) / k[seg]
+    dx = (x1 - x0)[seg]
+    dy = (y1 - y0)[seg]
+    px0, py0 = x0[seg] + dx * f0, y0[seg] + dy * f0
+    px1, py1 = x0[seg] + dx * f1, y0[seg] + dy * f1
+    pad = cell * 1e-9     # Pieces' ends are rounded
+    piece, cellid = _cover(np.minimum(px0, px1) - pad, np.minimum(py0, py1) - pad,
+                           np.maximum(px0, px1) + pad, np.maximum(py0, py1) + pad,
+                           gx, gy, cell, ncol)
+    seg = seg[piece]
+    order = np.lexsort((seg, cellid))
+    cellid = cellid[order]
+    seg = seg[order]
+    once = np.r_[True, (cellid[1:] != cellid[:-1]) | (seg[1:] != seg[:-1])]
+    cellid = cellid[once]
+    keys, starts = np.unique(cellid, return_index=True)
+    starts = np.append(starts, len(cellid)).astype(np.int64)
+    return (gx, gy, cell, ncol, keys, starts, seg[once])
+
+
+def _cover(xmin, ymin, xmax, ymax, gx, gy, cell, ncol):
+    # Expand each bounding box into (box index, cell id) pairs for every grid
+    # cell it overlaps. Boxes off the grid are clipped to its first row/column.
+    cx0 = np.maximum((xmin - gx) // cell, 0).astype(np.int64)
+    cy0 = np.maximum((ymin - gy) // cell, 0).astype(np.int64)
+    cx1 = np.minimum(np.maximum((xmax - gx) // cell, -1), ncol - 1).astype(np.int64)
+    cy1 = np.maximum((ymax - gy) // cell, -1).astype(np.int64)
+    nx = np.maximum(cx1 - cx0 + 1, 0)
+    ny = np.maximum(cy1 - cy0 + 1, 0)
+    n = nx * ny
+    box = np.repeat(np.arange(len(n), dtype=np.int64), n)
+    k = np.arange(n.sum(), dtype=np.int64) - np.repeat(np.cumsum(n) - n, n)
+    rnx = np.repeat(nx, n)
+    cx = np.repeat(cx0, n) + k % rnx
+    cy = np.repeat(cy0, n) + k // rnx
+    return box, cy * ncol + cx
+
+
+def ray_hits(ox, oy, az, length, grid, x0, y0, x1, y1,
+             ray_key=None, seg_key=None, tie=None, seg_ray=None):
+    """Nearest segment hit along each ray.
+
+    Rays start at (ox, oy) and run for length map units in direction az
+    (radians, counter-clockwise from east). Pairs whose ray_key equals the
+    segment's seg_key are skipped, which is how a dangle ignores its own line.
+    Hits at the ray origin are ignored. Segments hit at the same distance go
+    to the lowest tie key (the segment index by default), so the result does
+    not depend on the grid or on how the segments were split into tiles.
+    seg_ray gives (azimuth, length) of segments that are themselves
+    extensions from (x0, y0), which are then met by direction rather than
+    end point, so distances do not depend on how far they were drawn.
+
+    Returns (dist, hx, hy, seg) arrays with dist=inf, hx=hy=nan and seg=-1
+    for no hit.
+    """
+    ox = np.asarray(ox, dtype=np.float64)
+    oy = np.asarray(oy, dtype=np.float64)
+    length = np.asarray(length, dtype=np.float64)
+    dx = np.cos(az)
+    dy = np.sin(az)
+    n = len(ox)
+    if tie is None:
+        tie = np.arange(len(x0), dtype=np.int64)
+    best = np.full(n, np.inf)
+    bseg = np.full(n, -1, dtype=np.int64)
+    btie = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+    for q, s, t in _ray_blocks(ox, oy, dx, dy, length, grid, x0, y0, x1, y1,
+                               ray_key, seg_key, best, seg_ray):
+# Keep the smallest (t, tie) for each ray in this block, if before the best so far
+        order = np.lexsort((tie[s], t, q))
+        first = order[np.r_[True, q[order][1:] != q[order][:-1]]]
+        q, s, t = q[first], s[first], t[first]
+        better = (t < best[q]) | ((t == best[q]) & (tie[s] < btie[q]))
+        q, s, t = q[better], s[better], t[better]
+        best[q] = t
+        bseg[q] = s
+        btie[q] = tie[s]
+    miss = bseg < 0
+    hx = np.where(miss, np.nan, ox + np.where(miss, 0, best) * dx)
+    hy = np.where(miss, np.nan, oy + np.where(miss, 0, best) * dy)
+    return best, hx, hy, bseg
+
+
+def ray_pairs(ox, oy, az, length, grid, x0, y0, x1, y1,
+              ray_key=None, seg_key=None, seg_ray=None):
+    """Every segment hit along each ray, not just the nearest.
+
+    Arguments as for ray_hits(). Returns (ray, seg, dist) arrays, one entry
+    per ray and segment meeting, ordered by ray.
+    """
+    ox = np.asarray(ox, dtype=np.float64)
+    oy = np.asarray(oy, dtype=np.float64)
+    length = np.asarray(length, dtype=np.float64)
+    blocks = list(_ray_blocks(ox, oy, np.cos(az), np.sin(az), length, grid,
+                              x0, y0, x1, y1, ray_key, seg_key, None, seg_ray))
+    if not blocks:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    q, s, t = (np.concatenate(b) for b in zip(*blocks))
+# A segment spanning several cells of a ray is found once for each
+    order = np.lexsort((s, q))
+    q, s, t = q[order], s[order], t[order]
+    first = np.r_[True, (q[1:] != q[:-1]) | (s[1:] != s[:-1])]
+    return q[first], s[first], t[first]
+
+
+def _ray_blocks(ox, oy, dx, dy, length, grid, x0, y0, x1, y1,
+                ray_key=None, seg_key=None, best=None, seg_ray=None):
+    # Blocks of (ray, segment, t) for the ray/segment pairs that meet, at
+    # most CHUNK pairs tested at a time. If given, only hits no further than
+    # best[ray] are passed on; it may be updated between blocks.
+    gx, gy, cell, ncol, keys, starts, items = grid
+    if len(ox) == 0 or len(keys) == 0:
+        return
+    if seg_ray is not None:
+        ux = np.cos(seg_ray[0])
+        uy = np.sin(seg_ray[0])
+        ulen = np.asarray(seg_ray[1], dtype=np.float64)
+
+    ex = ox + length * dx
+    ey = oy + length * dy
+    ray, cellid = _cover(np.minimum(ox, ex), np.minimum(oy, ey),
+                         np.maximum(ox, ex), np.maximum(oy, ey),
+                         gx, gy, cell, ncol)
+    pos = np.searchsorted(keys, cellid)
+    pos[pos == len(keys)] = 0
+    found = keys[pos] == cellid
+    ray = ray[found]
+    pos = pos[found]
+    counts = starts[pos + 1] - starts[pos]
+    cum = np.cumsum(counts)
+    cuts = np.searchsorted(cum, np.arange(CHUNK, cum[-1] if len(cum) else 0, CHUNK))
+    for lo, hi in zip(np.r_[0, cuts], np.r_[cuts, len(ray)]):
+        if hi <= lo:
+            continue
+        c = counts[lo:hi]
+        q = np.repeat(ray[lo:hi], c)
+        k = np.arange(c.sum(), dtype=np.int64) - np.repeat(np.cumsum(c) - c, c)
+        s = items[np.repeat(starts[pos[lo:hi]], c) + k]
+        if ray_key is not None:
+            keep = ray_key[q] != seg_key[s]
+            q = q[keep]
+            s = s[keep]
+        t = _intersect(ox[q], oy[q], dx[q], dy[q], length[q],
+                       x0[s], y0[s], x1[s], y1[s],
+                       None if seg_ray is None else (ux[s], uy[s], ulen[s]))
+        hit = t < np.inf
+        if best is not None:
+            hit &= t <= best[q]
+        if hit.any():
+            yield q[hit], s[hit], t[hit]
+
+
+def _intersect(ox, oy, dx, dy, length, x0, y0, x1, y1, seg_ray=None):
+    # Distance along each ray (origin o, unit direction d) to where it meets
+    # segment a-b, or inf. Touches at the ray origin do not count. With
+    # seg_ray (ux, uy, ulen) the segments are rays themselves, from a along
+    # unit direction u for ulen, and are met using only a and u, so the
+    # distance does not depend on how far the segment was drawn.
+    if seg_ray is None:
+        ex = x1 - x0
+        ey = y1 - y0
+        ulen = 1.0
+    else:
+        ex, ey, ulen = seg_ray
+    t, u, denom, ax, ay = _cross(ox, oy, dx, dy, x0, y0, ex, ey)
+    t = np.where((denom != 0) & (u >= 0) & (u <= ulen), t, np.inf)
+# Collinear overlap - first point of the segment reached along the ray
+    coll = (denom == 0) & (ax * dy - ay * dx == 0)
+    if coll.any():
+        ta = ax * dx + ay * dy
+        if seg_ray is None:
+            tb = (x1 - ox) * dx + (y1 - oy) * dy
+        else:
+            tb = ta + ulen * (ex * dx + ey * dy)
+        tc = np.minimum(ta, tb)
+        tc = np.where(np.maximum(ta, tb) < 0, np.inf, tc)
+        t = np.where(coll, tc, t)
+    return np.where((t > 0) & (t <= length), t, np.inf)
+
+
+def _cross(ox, oy, dx, dy, x0, y0, ex, ey):
+    # Where the line through o along d crosses the line through a along e:
+    # (t, u, denom, ax, ay) with the crossing at o + t d = a + u e
+    ax = x0 - ox
+    ay = y0 - oy
+    denom = dx * ey - dy * ex
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (ax * ey - ay * ex) / denom
+        u = (ax * dy - ay * dx) / denom
+    return t, u, denom, ax, ay
+
+
+def nearest_hits(ox, oy, az, length, line, x0, y0, x1, y1, seg_line, seg_cat,
+                 grid=None, key=None):
+    """Nearest hit of each dangle extension on the original lines and on the
+    other extensions.
+
+    ox, oy, az, length describe one extension per dangle, line is the id of
+    the line the dangle belongs to. Segments x0, y0, x1, y1 come from the
+    original lines, seg_line and seg_cat giving each segment's line id and cat.
+    grid is their build_grid() if already built, e.g. by build_index().
+    Ties in distance go to the lowest line id, or for extensions the lowest
+    key (the line*2+dend dangle key, default the dangle index), so they fall
+    the same way however the lines are split into tiles.
+
+    Returns two record arrays (HIT_DTYPE), one row per dangle: hits on the
+    original lines (cat is the line cat) and hits on other extensions (cat is
+    the index of the other dangle). dist is inf where there is no hit.
+    """
+    ox = np.asarray(ox, dtype=np.float64)
+    oy = np.asarray(oy, dtype=np.float64)
+    az = np.asarray(az, dtype=np.float64)
+    length = np.asarray(length, dtype=np.float64)
+    line = np.asarray(line, dtype=np.int64)
+    n = len(ox)
+    cell = length.max() if n else 1.0
+
+    orig = np.zeros(n, dtype=HIT_DTYPE)
+    if grid is None:
+        grid = build_grid(x0, y0, x1, y1, cell)
+    dist, hx, hy, seg = ray_hits(ox, oy, az, length, grid,
+                                 np.asarray(x0, dtype=np.float64),
+                                 np.asarray(y0, dtype=np.float64),
+                                 np.asarray(x1, dtype=np.float64),
+                                 np.asarray(y1, dtype=np.float64),
+                                 ray_key=line,
+                                 seg_key=np.asarray(seg_line, dtype=np.int64),
+                                 tie=np.asarray(seg_line, dtype=np.int64))
+    orig['dist'] = dist
+    orig['x'] = hx
+    orig['y'] = hy
+    orig['cat'] = -1
+    orig['cat'][seg >= 0] = np.asarray(seg_cat)[seg[seg >= 0]]
+
+# The extensions themselves, as segments
+    ex = ox + length * np.cos(az)
+    ey = oy + length * np.sin(az)
+    idx = np.arange(n, dtype=np.int64)
+    ext = np.zeros(n, dtype=HIT_DTYPE)
+    grid = build_grid(ox, oy, ex, ey, cell)
+    dist, hx, hy, seg = ray_hits(ox, oy, az, length, grid, ox, oy, ex, ey,
+                                 ray_key=idx, seg_key=idx,
+                                 tie=idx if key is None else np.asarray(key, dtype=np.int64),
+                                 seg_ray=(az, length))
+    ext['dist'] = dist
+    ext['x'] = hx
+    ext['y'] = hy
+    ext['cat'] = seg
+    return orig, ext
+
+
+def hit_candidates(orig, ext):
+    """Candidate intersects (CAND_DTYPE) from the nearest_hits() results."""
+    n = len(orig)
+    cand = np.zeros(2 * n, dtype=CAND_DTYPE)
+    cand['dangle'] = np.tile(np.arange(n, dtype=np.int64), 2)
+    cand['xtype'][:n] = ORIG
+    cand['xtype'][n:] = EXT
+    for field, src in (('other', 'cat'), ('dist', 'dist'), ('x', 'x'), ('y', 'y')):
+        cand[field] = np.concatenate([orig[src], ext[src]])
+    return cand[np.isfinite(cand['dist'])]
+
+
+def resolve(cand, n):
+    """Choose the intersect each of n dangles extends to.
+
+    cand holds every candidate intersect (CAND_DTYPE); for 'ext' candidates
+    other is the index of the other dangle. Each dangle takes its closest
+    candidate (an original line before an extension at the same distance).
+    Extensions that chose an extension which settled on something else (the
+    "jilted") then re-search their remaining candidates, ignoring extensions
+    that have already found an intersect - there is no second chance.
+
+    Returns a RESULT_DTYPE record array, one row per dangle.
+    """
+    cand, out = _closest(cand, n)
+    xtype = out['xtype']
+    jilted = _jilted(out)
+    if len(jilted) == 0:
+        return out
+
+    d = cand['dangle']
+    keep = cand['xtype'] != EXT
+    keep[~keep] = xtype[cand['other'][~keep]] == NULL
+    keep &= np.isin(d, jilted)
+    rest = cand[keep]
+    r = rest['dangle']
+    first = np.r_[True, r[1:] != r[:-1]] if len(r) else np.zeros(0, dtype=bool)
+    out[jilted] = (NULL, np.inf, np.nan, np.nan, -1, 0)
+    _take(out, r[first], rest[first])
+    return out
+
+
+def jilted(cand, n):
+    """The dangles resolve(cand, n) finds jilted: those whose closest
+    candidate is an extension that chose something else."""
+    return _jilted(_closest(cand, n)[1])
+
+
+def _closest(cand, n):
+    # The candidates sorted by dangle, then distance with original lines
+    # first, and a RESULT_DTYPE array of each dangle's closest
+    cand = cand[cand['dist'] > 0]  # Touching at the dangle end itself
+    cand = cand[np.lexsort((cand['xtype'], cand['dist'], cand['dangle']))]
+    d = cand['dangle']
+    first = np.r_[True, d[1:] != d[:-1]] if len(d) else np.zeros(0, dtype=bool)
+    out = np.zeros(n, dtype=RESULT_DTYPE)
+    out['dist'] = np.inf
+    out['x'] = np.nan
+    out['y'] = np.nan
+    out['other'] = -1
+    _take(out, d[first], cand[first])
+    return cand, out
+
+
+def _jilted(out):
+    # Closest choices of an extension whose own choice was something else
+    xtype = out['xtype']
+    other = out['other']
+    e = np.flatnonzero(xtype == EXT)
+    partner = other[e]
+    recip = (xtype[partner] == EXT) & (other[partner] == e)
+    return e[~recip & (xtype[partner] != NULL)]
+
+
+def _take(out, dangle, cand):
+    # Copy the chosen candidates into the result rows of their dangles
+    for field in ('xtype', 'dist', 'x', 'y', 'other', 'xid'):
+        out[field][dangle] = cand[field]
+
+
+def extend_lines(xy, offsets, line, cat, is_line=None, maxlen=200, scale=0.5, vlen=1,
+                 prof=NOPROF, index=None):
+    """Find the dangles of packed lines and the intersect each extends to.
+
+    index is a build_index() of the same lines, whose segments and grid are
+    then used instead of being rebuilt.
+
+    Returns (dangles, length, best): the DANGLE_DTYPE records, their search
+    lengths and the RESULT_DTYPE choice for each.
+    """
+    dangles, length, cand = search_candidates(xy, offsets, line, cat, is_line, maxlen, scale, vlen,
+                                              prof, index)
+    with prof.stage('resolve', len(cand), 'candidates'):
+        best = resolve(cand, len(dangles))
+    return dangles, length, best
+
+
+def search_candidates(xy, offsets, line, cat, is_line=None, maxlen=200, scale=0.5, vlen=1,
+                      prof=NOPROF, index=None):
+    """The search of extend_lines(), without the choice between intersects.
+
+    Returns (dangles, length, cand): the DANGLE_DTYPE records, their search
+    lengths and every candidate intersect (CAND_DTYPE) for resolve().
+    """
+    line = np.asarray(line, dtype=np.int64)
+    cat = np.asarray(cat, dtype=np.int64)
+    with prof.stage('dangles', len(line), 'lines'):
+        dangles = find_dangles(xy, offsets, line, cat, is_line, vlen)
+        length = search_length(dangles['length'], maxlen, scale)
+    with prof.stage('search', len(dangles), 'dangles'):
+        if index is None:
+            x0, y0, x1, y1, owner = line_segments(xy, offsets, is_line)
+            grid = None
+        else:
+            x0, y0, x1, y1, owner = (index[k] for k in ('x0', 'y0', 'x1', 'y1', 'owner'))
+            grid = index_grid(index)
+        orig, ext = nearest_hits(dangles['x'], dangles['y'], dangles['az'], length,
+                                 dangles['line'], x0, y0, x1, y1,
+                                 line[owner], cat[owner], grid,
+                                 dangles['line'] * 2 + dangles['dend'])
+        cand = hit_candidates(orig, ext)
+    return dangles, length, cand
+
+
+def sweep(xy, offsets, line, cat, is_line=None, combos=((200, 0.5),), vlen=1,
+          prof=NOPROF, index=None):
+    """extend_lines() for several (maxlen, scale) combinations at once.
+
+    Dangles are found and searched once, each at the longest search length
+    any combination gives it. A shorter search keeps the nearest line hit
+    if within its length, but may meet a different extension, as the other
+    extensions are shorter too, so every pair of extensions that meet is
+    kept and met again at each combination's lengths. Extensions are met by
+    direction (see ray_hits()) and ties broken by dangle key, so each
+    combination is resolved exactly as a separate run would.
+
+    Returns (dangles, results): the DANGLE_DTYPE records and, per
+    combination, the (length, best) that extend_lines() would give.
+    """
+    line = np.asarray(line, dtype=np.int64)
+    cat = np.asarray(cat, dtype=np.int64)
+    with prof.stage('dangles', len(line), 'lines'):
+        dangles = find_dangles(xy, offsets, line, cat, is_line, vlen)
+        lengths = [search_length(dangles['length'], m, s) for m, s in combos]
+        reach = np.max(lengths, axis=0) if len(dangles) else np.zeros(0)
+    n = len(dangles)
+    ox, oy, az = dangles['x'], dangles['y'], dangles['az']
+    with prof.stage('search', n, 'dangles'):
+        if index is None:
+            x0, y0, x1, y1, owner = line_segments(xy, offsets, is_line)
+            grid = build_grid(x0, y0, x1, y1, reach.max() if n else 1.0)
+        else:
+            x0, y0, x1, y1, owner = (index[k] for k in ('x0', 'y0', 'x1', 'y1', 'owner'))
+            grid = index_grid(index)
+        odist, ohx, ohy, oseg = ray_hits(ox, oy, az, reach, grid,
+                                         np.asarray(x0, dtype=np.float64),
+                                         np.asarray(y0, dtype=np.float64),
+                                         np.asarray(x1, dtype=np.float64),
+                                         np.asarray(y1, dtype=np.float64),
+                                         ray_key=dangles['line'], seg_key=line[owner],
+                                         tie=line[owner])
+        ocat = np.full(n, -1, dtype=np.int64)
+        ocat[oseg >= 0] = cat[owner][oseg[oseg >= 0]]
+        ex = ox + reach * np.cos(az)
+        ey = oy + reach * np.sin(az)
+        idx = np.arange(n, dtype=np.int64)
+        grid = build_grid(ox, oy, ex, ey, reach.max() if n else 1.0)
+        q, other, t = ray_pairs(ox, oy, az, reach, grid, ox, oy, ex, ey,
+                                ray_key=idx, seg_key=idx, seg_ray=(az, reach))
+        dx, dy = np.cos(az), np.sin(az)
+        key = dangles['line'] * 2 + dangles['dend']     # Ties as in nearest_hits()
+
+    results = []
+    with prof.stage('resolve', len(combos), 'combinations'):
+        for length in lengths:
+            orig = np.zeros(n, dtype=HIT_DTYPE)
+            near = odist <= length
+            orig['dist'] = np.where(near, odist, np.inf)
+            orig['x'] = np.where(near, ohx, np.nan)
+            orig['y'] = np.where(near, ohy, np.nan)
+            orig['cat'] = np.where(near, ocat, -1)
+            ext = np.zeros(n, dtype=HIT_DTYPE)
+            ext['dist'] = np.inf
+            ext['x'] = np.nan
+            ext['y'] = np.nan
+            ext['cat'] = -1
+# Each pair met again at this combination's lengths, as nearest_hits() would
+            t = _intersect(ox[q], oy[q], dx[q], dy[q], length[q], ox[other], oy[other], None, None,
+                           (dx[other], dy[other], length[other]))
+            ok = np.flatnonzero(t < np.inf)
+            order = ok[np.lexsort((key[other[ok]], t[ok], q[ok]))]
+            order = order[np.r_[True, q[order][1:] != q[order][:-1]]] if len(order) else order
+            ext['dist'][q[order]] = t[order]
+            ext['x'][q[order]] = ox[q[order]] + t[order] * dx[q[order]]
+            ext['y'][q[order]] = oy[q[order]] + t[order] * dy[q[order]]
+            ext['cat'][q[order]] = other[order]
+            results.append((length, resolve(hit_candidates(orig, ext), n)))
+    return dangles, results
+
+
+def extend_passes(dangles, length, best, passes=1, overshoot=OVERSHOOT, prof=NOPROF):
+    """Repeat extension for the dangles left unextended by extend_lines()
+    (or extend_tiled(), sweep()), as re-running on the extended lines would.
+
+    A dangle left without an intersect had no original line within reach,
+    so each further pass only tests it against the extensions made by the
+    previous pass, as segments of their lines, and against the extensions
+    of the other dangles still left. Hits on extended lines count as 'orig'
+    with other the line's cat. passes includes the first; 0 repeats until a
+    pass extends nothing more. best is updated in place.
+
+    Returns the number of passes made.
+    """
+    n = len(dangles)
+    ox, oy, az = dangles['x'], dangles['y'], dangles['az']
+    done = best['xtype'] != NULL
+    new = done.copy()
+    made = 1
+    while (passes == 0 or made < passes) and new.any() and not done.all():
+        pend = np.flatnonzero(~done)
+        with prof.stage('pass', len(pend), 'dangles'):
+# The last pass's extensions, as segments of their lines
+            sub = np.flatnonzero(new)
+            mods, x1, y1 = new_ends(dangles[sub], best[sub], overshoot)
+            seg = sub[mods]
+            x0, y0 = ox[seg], oy[seg]
+            cell = length[pend].max()
+            grid = build_grid(x0, y0, x1, y1, cell)
+            dist, hx, hy, hit = ray_hits(ox[pend], oy[pend], az[pend], length[pend], grid,
+                                         x0, y0, x1, y1, ray_key=dangles['line'][pend],
+                                         seg_key=dangles['line'][seg], tie=dangles['line'][seg])
+            orig = np.zeros(len(pend), dtype=HIT_DTYPE)
+            orig['dist'] = dist
+            orig['x'] = hx
+            orig['y'] = hy
+            orig['cat'] = -1
+            orig['cat'][hit >= 0] = dangles['cat'][seg[hit[hit >= 0]]]
+# and the extensions of the dangles still left
+            ex = ox[pend] + length[pend] * np.cos(az[pend])
+            ey = oy[pend] + length[pend] * np.sin(az[pend])
+            idx = np.arange(len(pend), dtype=np.int64)
+            grid = build_grid(ox[pend], oy[pend], ex, ey, cell)
+            dist, hx, hy, hit = ray_hits(ox[pend], oy[pend], az[pend], length[pend], grid,
+                                         ox[pend], oy[pend], ex, ey, ray_key=idx, seg_key=idx,
+                                         seg_ray=(az[pend], length[pend]))
+            ext = np.zeros(len(pend), dtype=HIT_DTYPE)
+            ext['dist'] = dist
+            ext['x'] = hx
+            ext['y'] = hy
+            ext['cat'] = hit
+            got = resolve(hit_candidates(orig, ext), len(pend))
+            e = got['xtype'] == EXT
+            got['other'][e] = pend[got['other'][e]]
+            found = got['xtype'] != NULL
+            best[pend[found]] = got[found]
+            new = np.zeros(n, dtype=bool)
+            new[pend[found]] = True
+            done |= new
+        made += 1
+    return made
+
+
+def extend_tiled(xy, offsets, line, cat, is_line=None, maxlen=200, scale=0.5,
+                 vlen=1, nprocs=1, prof=NOPROF, index=None, pool=None):
+    """extend_lines() split over spatial tiles run in a pool of nprocs
+    processes.
+
+    An extension never reaches further than maxlen, but whether it is jilted
+    depends on what the extension it meets chose, which in turn depends on
+    that extension's own hits. Each tile therefore carries a halo of
+    4 x maxlen and keeps only the dangles whose end lies in its core, which
+    gives the same result as a single run. Tiles are profiled as a whole,
+    as one 'tiles' stage. index (see extend_lines()) is only used when the
+    lines are not split. pool is a multiprocessing pool of nprocs workers to
+    run the tiles in, for a caller that has to start it early (workers are
+    forked, so before any threads); by default one is started here.
+    """
+    line = np.asarray(line, dtype=np.int64)
+    cat = np.asarray(cat, dtype=np.int64)
+    n = len(offsets) - 1
+    if is_line is None:
+        is_line = np.ones(n, dtype=bool)
+    is_line = np.asarray(is_line, dtype=bool)
+    if n == 0 or nprocs < 2:
+        return extend_lines(xy, offsets, line, cat, is_line, maxlen, scale, vlen, prof, index)
+
+    bx0, by0, bx1, by1 = line_boxes(xy, offsets)
+    gx, gy = bx0.min(), by0.min()
+    width = bx1.max() - gx
+    height = by1.max() - gy
+    halo = 4.0 * maxlen
+# Around four tiles per process, but no smaller than their halo
+    size = max(np.sqrt(width * height / (4.0 * nprocs)), width / (4.0 * nprocs),
+               height / (4.0 * nprocs), halo, 1.0)
+    ntx = int(width // size) + 1
+    nty = int(height // size) + 1
+    if ntx * nty == 1:
+        return extend_lines(xy, offsets, line, cat, is_line, maxlen, scale, vlen, prof, index)
+
+    def jobs():
+        for j in range(nty):
+            for i in range(ntx):
+                core = (gx + i * size, gy + j * size,
+                        gx + (i + 1) * size, gy + (j + 1) * size)
+                sel = np.flatnonzero((bx1 >= core[0] - halo) & (bx0 <= core[2] + halo) &
+                                     (by1 >= core[1] - halo) & (by0 <= core[3] + halo))
+                if len(sel):
+                    sxy, soff = _subset(xy, offsets, sel)
+                    yield (core, sxy, soff, line[sel], cat[sel], is_line[sel],
+                           maxlen, scale, vlen)
+
+    own = pool is None
+    if own:
+        pool = multiprocessing.Pool(nprocs)
+    try:
+        with prof.stage('tiles', unit='tiles') as rec:
+            parts = list(pool.imap_unordered(_tile_job, jobs()))
+            rec['items'] = len(parts)
+    finally:
+        if own:
+            pool.terminate()
+    dangles = np.concatenate([p[0] for p in parts])
+    length = np.concatenate([p[1] for p in parts])
+    best = np.concatenate([p[2] for p in parts])
+    partner = np.concatenate([p[3] for p in parts])
+
+# Back into line order, and 'ext' partners from dangle keys to indices
+    key = dangles['line'] * 2 + dangles['dend']
+    order = np.argsort(key, kind='stable')
+    dangles = dangles[order]
+    length = length[order]
+    best = best[order]
+    partner = partner[order]
+    e = best['xtype'] == EXT
+    best['other'][e] = np.searchsorted(key[order], partner[e])
+    return dangles, length, best
+
+
+def _subset(xy, offsets, sel):
+    # Packed arrays holding only the lines in sel
+    nv = np.diff(offsets)[sel]
+    soff = np.zeros(len(sel) + 1, dtype=np.int64)
+    soff[1:] = np.cumsum(nv)
+    i = np.arange(soff[-1], dtype=np.int64) - np.repeat(soff[:-1], nv)
+    return xy[np.repeat(offsets[sel], nv) + i], soff
+
+
+def _tile_job(job):
+    return extend_core(*job)
+
+
+def extend_core(core, xy, offsets, line, cat, is_line=None, maxlen=200,
+                scale=0.5, vlen=1, prof=NOPROF):
+    """extend_lines() for a tile, keeping the dangles whose end lies in the
+    core box (x0, y0, x1, y1), lower edges included.
+
+    The lines passed must cover the core plus a 4 x maxlen halo. Returns
+    (dangles, length, best, partner) where partner holds the line*2+dend key
+    of the dangle met by each 'ext' choice (-1 otherwise), as best['other']
+    only indexes dangles within this tile.
+    """
+    dangles, length, best = extend_lines(xy, offsets, line, cat, is_line,
+                                         maxlen, scale, vlen, prof)
+    x0, y0, x1, y1 = core
+    own = ((dangles['x'] >= x0) & (dangles['x'] < x1) &
+           (dangles['y'] >= y0) & (dangles['y'] < y1))
+    return _keep(dangles, length, best, own)
+
+
+def extend_near(boxes, xy, offsets, line, cat, is_line=None, maxlen=200,
+                scale=0.5, vlen=1, prof=NOPROF):
+    """extend_lines() for just the dangles within 4 x maxlen of any of boxes,
+    an (m, 4) array of (x0, y0, x1, y1) such as the extents of edited lines.
+
+    Dangles further away keep the result of an earlier run, as nothing they
+    depend on has changed (see extend_tiled()). Only lines within 8 x maxlen
+    of the boxes are searched. Returns (dangles, length, best, partner) as
+    extend_core().
+    """
+    line = np.asarray(line, dtype=np.int64)
+    cat = np.asarray(cat, dtype=np.int64)
+    n = len(offsets) - 1
+    if is_line is None:
+        is_line = np.ones(n, dtype=bool)
+    is_line = np.asarray(is_line, dtype=bool)
+    halo = 4.0 * maxlen
+    sel = np.flatnonzero(near_boxes(boxes, *line_boxes(xy, offsets), pad=2.0 * halo)) if n else []
+    sxy, soff = _subset(xy, offsets, sel)
+    dangles, length, best = extend_lines(sxy, soff, line[sel], cat[sel], is_line[sel],
+                                         maxlen, scale, vlen, prof)
+    own = near_boxes(boxes, dangles['x'], dangles['y'], dangles['x'], dangles['y'], pad=halo)
+    return _keep(dangles, length, best, own)
+
+
+def _keep(dangles, length, best, own):
+    # The own dangles, and the line*2+dend key of the dangle each 'ext'
+    # choice meets, as best['other'] only indexes the dangles passed
+    key = dangles['line'] * 2 + dangles['dend']
+    e = best['xtype'] == EXT
+    partner = np.full(len(dangles), -1, dtype=np.int64)
+    partner[e] = key[best['other'][e]]
+    return dangles[own], length[own], best[own], partner[own]
+
+
+
+def line_hashes(xy, offsets):
+    """A 64-bit hash (as int64) of each packed line's coordinates.
+
+    Each vertex's coordinate bits and place in its line are mixed
+    (splitmix64) and the results summed per line, all in one vectorised
+    pass, so a changed, moved, added or dropped vertex changes the hash.
+    """
+    n = len(offsets) - 1
+    nv = np.diff(offsets)
+    out = np.zeros(n, dtype=np.uint64)
+    if len(xy):
+        bits = np.ascontiguousarray(xy[:, :2], dtype=np.float64).view(np.uint64)
+        place = (np.arange(len(xy), dtype=np.int64) - np.repeat(offsets[:-1], nv)).astype(np.uint64)
+        h = _mix(bits[:, 0] ^ _mix(bits[:, 1] ^ _mix(place)))
+        live = nv > 0
+        out[live] = np.add.reduceat(h, offsets[:-1][live])
+    return _mix(out ^ nv.astype(np.uint64)).view(np.int64)
+
+
+def _mix(h):
+    # splitmix64's finaliser, wrapping like the C original
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+def line_boxes(xy, offsets):
+    """Bounding boxes (x0, y0, x1, y1) of packed lines, one array each."""
+    first = offsets[:-1]
+    return (np.minimum.reduceat(xy[:, 0], first), np.minimum.reduceat(xy[:, 1], first),
+            np.maximum.reduceat(xy[:, 0], first), np.maximum.reduceat(xy[:, 1], first))
+
+
+def near_boxes(boxes, bx0, by0, bx1, by1, pad=0.0):
+    """Mask of the boxes (bx0, by0, bx1, by1) lying within pad of any of
+    boxes, an (m, 4) array of (x0, y0, x1, y1)."""
+    near = np.zeros(len(bx0), dtype=bool)
+    for x0, y0, x1, y1 in boxes:
+        near |= ((bx1 >= x0 - pad) & (bx0 <= x1 + pad) &
+                 (by1 >= y0 - pad) & (by0 <= y1 + pad))
+    return near
+
+
+def build_index(xy, offsets, line, cat, is_line=None, cell=200, **meta):
+    """Segment index of packed lines for repeated searches.
+
+    A dict of the packed lines (xy, offsets, line, cat, is_line), the
+    line_segments() of those flagged in is_line (x0, y0, x1, y1, owner) and
+    their build_grid() with the given cell size (gx, gy, cell, ncol, keys,
+    starts, items). meta items, such as a stamp identifying the source, are
+    kept with it.
+    """
+    n = len(offsets) - 1
+    if is_line is None:
+        is_line = np.ones(n, dtype=bool)
+    x0, y0, x1, y1, owner = line_segments(xy, offsets, is_line)
+    gx, gy, cell, ncol, keys, starts, items = build_grid(x0, y0, x1, y1, cell)
+    index = dict(meta)
+    index.update(xy=xy, offsets=offsets, line=np.asarray(line, dtype=np.int64),
+                 cat=np.asarray(cat, dtype=np.int64), is_line=np.asarray(is_line, dtype=bool),
+                 x0=x0, y0=y0, x1=x1, y1=y1, owner=owner,
+                 gx=float(gx), gy=float(gy), cell=float(cell), ncol=int(ncol),
+                 keys=keys, starts=starts, items=items)
+    return index
+
+
+def index_grid(index):
+    """The build_grid() tuple held in a build_index() dict."""
+    return tuple(index[k] for k in ('gx', 'gy', 'cell', 'ncol', 'keys', 'starts', 'items'))
+
+
+def save_index(path, index):
+    """Save a build_index() dict in directory path, each array as a .npy
+    file and everything else in index.json.
+
+    Files are replaced rather than overwritten, so processes still mapping
+    an older index are unaffected. index.json is written last and marks the
+    index complete.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    head = os.path.join(path, 'index.json')
+    if os.path.exists(head):
+        os.remove(head)
+    meta = {}
+    for k, v in index.items():
+        if k in INDEX_ARRAYS:
+            tmp = os.path.join(path, k + '.tmp.npy')
+            np.save(tmp, np.asarray(v))
+            os.replace(tmp, os.path.join(path, k + '.npy'))
+        else:
+            meta[k] = v
+    with open(head + '.tmp', 'w') as fh:
+        json.dump(meta, fh)
+    os.replace(head + '.tmp', head)
+
+
+def load_index(path, stamp=None):
+    """The index saved by save_index() in directory path, with its arrays
+    memory-mapped read only. None if there is no complete index there, or
+    its 'stamp' differs from the one given (e.g. the source has changed).
+    """
+    try:
+        with open(os.path.join(path, 'index.json')) as fh:
+            index = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if stamp is not None and index.get('stamp') != stamp:
+        return None
+    for k in INDEX_ARRAYS:
+        index[k] = np.load(os.path.join(path, k + '.npy'), mmap_mode='r')
+    return index
+
+
+def quad_tiles(x0, y0, x1, y1, halo, count, limit, depth=0):
+    """Cover the box with square tiles, splitting into quadrants until
+    count(x0, y0, x1, y1) of a tile plus its halo is at most limit.
+
+    Tiles are yielded as core boxes (x0, y0, x1, y1), for use with
+    extend_core(). Tiles with nothing in them are skipped and none is split
+    below twice the halo. The first depth splits are made without counting,
+    so count() need never be asked about the whole of a big box.
+    """
+    size = max(x1 - x0, y1 - y0, halo) * 1.001  # Upper edges are not owned
+    stack = [(x0, y0, size, depth)]
+    while stack:
+        x, y, s, d = stack.pop()
+        if d > 0 and s > 2 * halo:
+            h = s / 2
+            stack.extend([(x + h, y + h, h, d - 1), (x, y + h, h, d - 1), (x + h, y, h, d - 1), (x, y, h, d - 1)])
+            continue
+        n = count(x - halo, y - halo, x + s + halo, y + s + halo)
+        if n == 0:
+            continue
+        if n <= limit or s <= 2 * halo:
+            yield (x, y, x + s, y + s)
+        else:
+            h = s / 2
+            stack.extend([(x + h, y + h, h, 0), (x, y + h, h, 0), (x + h, y, h, 0), (x, y, h, 0)])
+
+
+def new_ends(dangles, best, overshoot=OVERSHOOT):
+    """New end points of the dangles that extend.
+
+    Returns (index, x, y): the dangles with an intersect and where their ends
+    move to. Ends on original lines are pushed overshoot past the hit.
+    """
+    mods = np.flatnonzero(best['xtype'] != NULL)
+    x = best['x'][mods]
+    y = best['y'][mods]
+    az = dangles['az'][mods]
+    over = np.where(best['xtype'][mods] == ORIG, overshoot, 0.0)
+    return mods, x + over * np.cos(az), y + over * np.sin(az)
+
+
+def snap_lines(xy, offsets, line, cat, dangles, best, is_line=None):
+    """Lines extended to meet exactly, instead of overshooting.
+
+    Each extended end stops on its hit point (new_ends() with no overshoot)
+    and the line met is split there, so the hit point is an end of three
+    lines and a node. Extensions meeting each other end on one common point.
+    The line met is the one with the nearest segment to the hit point,
+    preferring the hit's cat, and may itself have been extended (by
+    extend_passes()). dangles and best come from extend_lines() or
+    extend_tiled() on the same packed lines.
+
+    Returns (changed, coords): the indices of the packed lines that change,
+    in order, and for each a list of its new (n, 2) coordinate arrays, the
+    parts it is split into in order along it (just one if not split).
+    """
+    line = np.asarray(line, dtype=np.int64)
+    cat = np.asarray(cat, dtype=np.int64)
+    n = len(offsets) - 1
+    if is_line is None:
+        is_line = np.ones(n, dtype=bool)
+    sorter = np.argsort(line, kind='stable')
+    pos = sorter[np.searchsorted(line, dangles['line'], sorter=sorter)]
+    xtype = best['xtype']
+    x = best['x'].copy()
+    y = best['y'].copy()
+# Extensions meeting each other take the point of the lower dangle
+    e = np.flatnonzero(xtype == EXT)
+    p = best['other'][e]
+    pair = (xtype[p] == EXT) & (best['other'][p] == e) & (p < e)
+    x[e[pair]] = x[p[pair]]
+    y[e[pair]] = y[p[pair]]
+    mods = np.flatnonzero(xtype != NULL)
+
+    nv = np.diff(offsets)
+    head = np.zeros(n, dtype=np.int64)
+    tail = np.zeros(n, dtype=np.int64)
+    head[pos[mods][dangles['dend'][mods] == HEAD]] = 1
+    tail[pos[mods][dangles['dend'][mods] == TAIL]] = 1
+# Segments of the extended lines: the original ones, shifted along by a new
+# head, and the extensions. k is the segment's place in its extended line.
+    x0, y0, x1, y1, owner = line_segments(xy, offsets, is_line)
+    k = np.arange(len(owner), dtype=np.int64) - np.searchsorted(owner, owner) + head[owner]
+    mpos = pos[mods]
+    x0 = np.concatenate([x0, dangles['x'][mods]])
+    y0 = np.concatenate([y0, dangles['y'][mods]])
+    x1 = np.concatenate([x1, x[mods]])
+    y1 = np.concatenate([y1, y[mods]])
+    owner = np.concatenate([owner, mpos])
+    k = np.concatenate([k, np.where(dangles['dend'][mods] == HEAD, 0, nv[mpos] + head[mpos] + tail[mpos] - 2)])
+
+# The segment each 'orig' hit lies on
+    hits = mods[xtype[mods] == ORIG]
+    hx, hy = x[hits], y[hits]
+    seglen = np.hypot(x1 - x0, y1 - y0)
+    cell = float(np.median(seglen)) * 4 if len(seglen) else 1.0
+    grid = build_grid(x0, y0, x1, y1, cell if cell > 0 else 1.0)
+    gx, gy, cell, ncol, keys, starts, items = grid
+    q, cellid = _cover(hx, hy, hx, hy, gx, gy, cell, ncol)
+    at = np.searchsorted(keys, cellid)
+    at[at == len(keys)] = 0
+    found = keys[at] == cellid if len(keys) else np.zeros(len(q), dtype=bool)
+    q, at = q[found], at[found]
+    c = starts[at + 1] - starts[at]
+    q = np.repeat(q, c)
+    j = np.arange(c.sum(), dtype=np.int64) - np.repeat(np.cumsum(c) - c, c)
+    sg = items[np.repeat(starts[at], c) + j]
+    keep = owner[sg] != pos[hits][q]
+    q, sg = q[keep], sg[keep]
+    vx, vy = x1[sg] - x0[sg], y1[sg] - y0[sg]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip(((hx[q] - x0[sg]) * vx + (hy[q] - y0[sg]) * vy) / (vx * vx + vy * vy), 0, 1)
+    t = np.nan_to_num(t)
+    dist = np.hypot(x0[sg] + t * vx - hx[q], y0[sg] + t * vy - hy[q])
+    other = cat[owner[sg]] != best['other'][hits][q]
+    order = np.lexsort((dist, other, q))
+    q, sg, t = q[order], sg[order], t[order]
+    first = np.r_[True, q[1:] != q[:-1]] if len(q) else np.zeros(0, dtype=bool)
+    q, sg, t = q[first], sg[first], t[first]
+# A hit on a vertex of the line met splits it there, one on its end is
+# already a node. v is the vertex hit, in the extended line.
+    at0 = (hx[q] == x0[sg]) & (hy[q] == y0[sg])
+    at1 = (hx[q] == x1[sg]) & (hy[q] == y1[sg])
+    on = at0 | at1
+    v = k[sg] + at1
+    last = nv[owner[sg]] + head[owner[sg]] + tail[owner[sg]] - 1
+    split = ~on | ((v > 0) & (v < last))
+    q, sg, t, on, v = q[split], sg[split], t[split], on[split], v[split]
+
+    changed = np.union1d(mpos, owner[sg]).astype(np.int64)
+    coords = []
+    ends = {}
+    for i in mods:
+        ends.setdefault(pos[i], []).append((dangles['dend'][i], x[i], y[i]))
+    inserts = {}
+    vertices = {}
+    for i in np.lexsort((t, k[sg], owner[sg])):
+        j = owner[sg[i]]
+        if on[i]:
+            vertices.setdefault(j, set()).add(v[i])
+        elif (k[sg[i]], hx[q[i]], hy[q[i]]) not in inserts.get(j, [])[-1:]:   # Two hits on one point
+            inserts.setdefault(j, []).append((k[sg[i]], hx[q[i]], hy[q[i]]))
+    for j in changed:
+        c = np.asarray(xy[offsets[j]:offsets[j + 1]], dtype=np.float64)
+        for dend, ex, ey in ends.get(j, []):
+            c = np.concatenate([[(ex, ey)], c]) if dend == HEAD else np.concatenate([c, [(ex, ey)]])
+# Vertices split at, moved along by the points inserted before them
+        at = np.array([a for a, _, _ in inserts.get(j, [])], dtype=np.int64)
+        cut = [a + 1 + i for i, a in enumerate(at)]
+        cut.extend(w + np.searchsorted(at + 1, w, side='right') for w in vertices.get(j, ()))
+        if j in inserts:
+            _, px, py = zip(*inserts[j])
+            c = np.insert(c, at + 1, np.column_stack([px, py]), axis=0)
+        cut = [0] + sorted(set(int(w) for w in cut)) + [len(c) - 1]
+        coords.append([c[a:b + 1] for a, b in zip(cut[:-1], cut[1:])])
+    return changed, coords
+
+
+def extend_dangles(lines, maxlen=200, scale=0.5, vlen=1, is_line=None, nprocs=1,
+                   overshoot=OVERSHOOT):
+    """Extend the dangles of a set of lines.
+
+    lines is a sequence of (n, 2) coordinate arrays (extra columns such as z
+    are ignored); lines without vertices are skipped. Where is_line is given,
+    only flagged lines are extended or met; the others still join lines at
+    shared end points. Each dangle is extended up to the lesser of maxlen and
+    scale x its line's length (maxlen alone if scale is 0), to the nearest
+    original line or other extension, and overshoot map units past it, as
+    for new_ends().
+
+    Returns an EXTENSION_DTYPE record array, one row per dangle, line being
+    the index into lines. For 'orig' hits other is the index of the line met,
+    for 'ext' hits the row of the other dangle.
+    """
+    idx = np.array([k for k, c in enumerate(lines) if len(c)], dtype=np.int64)
+    xy, offsets = pack_lines([lines[k] for k in idx])
+    if is_line is not None:
+        is_line = np.asarray(is_line, dtype=bool)[idx]
+    dangles, length, best = extend_tiled(xy, offsets, idx, idx, is_line,
+                                         maxlen, scale, vlen, nprocs)
+    out = np.zeros(len(dangles), dtype=EXTENSION_DTYPE)
+    for field in ('line', 'dend', 'x', 'y', 'az'):
+        out[field] = dangles[field]
+    out['search_len'] = length
+    for field in ('xtype', 'other', 'dist'):
+        out[field] = best[field]
+    out['ex'] = dangles['x']
+    out['ey'] = dangles['y']
+    mods, x, y = new_ends(dangles, best, overshoot)
+    out['ex'][mods] = x
+    out['ey'][mods] = y
+    return out
+
+
+def extend_coords(lines, maxlen=200, scale=0.5, vlen=1, is_line=None, nprocs=1,
+                  overshoot=OVERSHOOT):
+    """Lines with their dangles extended, as a list of (n, 2) arrays.
+
+    Arguments as for extend_dangles(). Lines without an extending dangle are
+    returned unchanged (as float arrays).
+    """
+    ext = extend_dangles(lines, maxlen, scale, vlen, is_line, nprocs, overshoot)
+    out = [_coords(c) for c in lines]
+    for row in ext[ext['xtype'] != NULL]:
+        end = [(row['ex'], row['ey'])]
+        i = row['line']
+        if row['dend'] == HEAD:
+            out[i] = np.concatenate([end, out[i]])
+        else:
+            out[i] = np.concatenate([out[i], end])
+    return out
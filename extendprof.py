@@ -0,0 +1,156 @@
+#######################################################################################
+#
+# MODULE:       extendprof
+# AUTHOR(S):    David Pairman <pairmand landcareresearch.co.nz>
+# PURPOSE:      Per-stage timing and memory records for v.extendline
+# COPYRIGHT:    (C) 2015 Landcare Research New Zealand Ltd
+#
+#               This program is free software under the GNU General Public
+#               License (version 3). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#######################################################################################
+"""
+Per-stage profiling for v.extendline and extendlib.
+
+A Profiler records, for each named stage, wall time, CPU time (including
+finished child processes such as v.distance or pool workers), peak RSS and
+an optional item count with its throughput. Stages are marked either with
+begin()/end() or the stage() context manager; a stage run more than once
+(e.g. per tile) adds up into one record. Stages run concurrently with
+others are timed by the caller and recorded with add(), without CPU time,
+which can't be told apart between threads. The records can be printed as a
+table or written to JSON. NOPROF does nothing and is the
+default wherever a profiler is optional.
+"""
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _cpu():
+    # CPU seconds used by this process and its waited-for children
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + kids.ru_utime + kids.ru_stime
+
+
+def _peak_rss():
+    # Peak resident set size in MB of this process or its largest child
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / (2.0**20 if sys.platform == 'darwin' else 2.0**10)
+
+
+class Profiler(object):
+    """Collects one record per pipeline stage."""
+
+    def __init__(self):
+        self.stages = []
+        self._named = {}
+        self._open = None
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def begin(self, name):
+        """Start timing stage name, ending any stage still open."""
+        if self._open is not None:
+            self.end()
+        self._open = {'stage': name, 'wall': time.time(), 'cpu': _cpu()}
+        return self._open
+
+    def end(self, items=None, unit=None):
+        """End the open stage, recording items processed (of unit)."""
+        rec = self._open
+        if rec is None:
+            return None
+        self._open = None
+        wall = time.time() - rec.pop('wall')
+        cpu = _cpu() - rec.pop('cpu')
+        if items is None:
+            items = rec.pop('items', None)
+        return self._record(rec['stage'], wall, cpu, items, unit or rec.pop('unit', None))
+
+    def add(self, name, wall, items=None, unit=None):
+        """Record wall seconds of stage name, timed by the caller (e.g. one
+        run in a thread alongside others). Safe to call from any thread."""
+        return self._record(name, wall, None, items, unit)
+
+    def _record(self, name, wall, cpu, items, unit):
+        with self._lock:
+            total = self._named.get(name)
+            if total is None:
+                total = {'stage': name, 'calls': 0, 'wall': 0.0, 'cpu': 0.0 if cpu is not None else None}
+                self._named[name] = total
+                self.stages.append(total)
+            total['calls'] += 1
+            total['wall'] += wall
+            if cpu is not None:
+                total['cpu'] = (total['cpu'] or 0.0) + cpu
+            total['peak_rss_mb'] = _peak_rss()
+            if items is not None:
+                total['items'] = total.get('items', 0) + int(items)
+            if unit is not None:
+                total['unit'] = unit
+            if total.get('items') is not None and total['wall'] > 0:
+                total['items_per_sec'] = total['items'] / total['wall']
+        return total
+
+    @contextmanager
+    def stage(self, name, items=None, unit=None):
+        """Time the enclosed block as stage name. A dict is yielded in which
+        'items' and 'unit' can be set once known."""
+        rec = self.begin(name)
+        rec.update({'items': items, 'unit': unit})
+        try:
+            yield rec
+        finally:
+            if self._open is rec:
+                self.end()
+
+    def summary(self):
+        """The stage records as a text table."""
+        lines = ["{:<20} {:>10} {:>10} {:>10} {:>12} {:>14}".format(
+            'stage', 'wall (s)', 'cpu (s)', 'rss (MB)', 'items', 'items/s')]
+        for rec in self.stages:
+            items = rec.get('items')
+            rate = rec.get('items_per_sec')
+            lines.append("{:<20} {:>10.3f} {:>10} {:>10.1f} {:>12} {:>14}".format(
+                rec['stage'], rec['wall'], '' if rec['cpu'] is None else "{:.3f}".format(rec['cpu']),
+                rec['peak_rss_mb'],
+                '' if items is None else "{} {}".format(items, rec.get('unit', '')).strip(),
+                '' if rate is None else "{:.1f}".format(rate)))
+        lines.append("{:<20} {:>10.3f}".format('total', time.time() - self._start))
+        return "\n".join(lines)
+
+    def write(self, filename, **meta):
+        """Write the stage records, with meta data about the run, as JSON."""
+        doc = {'meta': meta,
+               'total_wall': time.time() - self._start,
+               'peak_rss_mb': _peak_rss(),
+               'stages': self.stages}
+        with open(filename, 'w') as fh:
+            json.dump(doc, fh, indent=2)
+
+
+class _NoProfiler(object):
+    # Stand-in used when profiling is off
+
+    def begin(self, name):
+        return {}
+
+    def end(self, items=None, unit=None):
+        return None
+
+    def add(self, name, wall, items=None, unit=None):
+        return None
+
+    @contextmanager
+    def stage(self, name, items=None, unit=None):
+        yield {}
+
+
+NOPROF = _NoProfiler()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# extendlib and extendprof live at the top of the repo, the generator in benchmark/
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmark'))
@@ -0,0 +1,206 @@
+"""
+extend_dangles() and extend_coords() on small hand-built networks, one for
+each kind of intersect a dangle can end up with.
+"""
+import numpy as np
+import pytest
+
+import extendlib
+from extendlib import EXT, HEAD, NULL, ORIG, TAIL
+from paddocks import paddocks
+
+
+def line(*xy):
+    return np.array(xy, dtype=np.float64)
+
+
+def row(ext, k, dend):
+    sel = np.flatnonzero((ext['line'] == k) & (ext['dend'] == dend))
+    assert len(sel) == 1
+    return ext[sel[0]]
+
+
+def test_orig():
+    # The head of a vertical line 10 above a horizontal one
+    lines = [line((0, 0), (100, 0)), line((50, 10), (50, 100))]
+    ext = extendlib.extend_dangles(lines, overshoot=0)
+    r = row(ext, 1, HEAD)
+    assert r['xtype'] == ORIG and r['other'] == 0
+    assert r['dist'] == pytest.approx(10)
+    assert (r['ex'], r['ey']) == pytest.approx((50, 0))
+    assert row(ext, 1, TAIL)['xtype'] == NULL
+
+
+def test_ext():
+    # Two tails whose extensions cross at the origin, 10 and 20 away
+    lines = [line((-100, 0), (-10, 0)), line((0, -100), (0, -20))]
+    ext = extendlib.extend_dangles(lines, overshoot=0)
+    a, b = row(ext, 0, TAIL), row(ext, 1, TAIL)
+    assert a['xtype'] == EXT and b['xtype'] == EXT
+    assert ext[a['other']]['line'] == 1 and ext[b['other']]['line'] == 0
+    assert (a['dist'], b['dist']) == pytest.approx((10, 20))
+    assert (a['ex'], a['ey']) == pytest.approx((0, 0))
+    assert (b['ex'], b['ey']) == pytest.approx((0, 0))
+
+
+def test_jilted():
+    # Line 0 would meet line 1's extension, but line 1 stops at the short
+    # line 2 first; jilted, line 0 goes on to line 3
+    lines = [line((-100, 0), (-10, 0)), line((0, -100), (0, -5)),
+             line((-1, -3), (1, -3)), line((20, -50), (20, 50))]
+    alone = extendlib.extend_dangles(lines[:2] + lines[3:], overshoot=0)
+    assert row(alone, 0, TAIL)['xtype'] == EXT
+    ext = extendlib.extend_dangles(lines, overshoot=0)
+    b = row(ext, 1, TAIL)
+    assert b['xtype'] == ORIG and b['other'] == 2
+    a = row(ext, 0, TAIL)
+    assert a['xtype'] == ORIG and a['other'] == 3
+    assert a['dist'] == pytest.approx(30)
+
+
+def test_null():
+    # Out of reach: scale x length is 5, the other line 10 away
+    lines = [line((0, 0), (100, 0)), line((50, 10), (50, 20))]
+    ext = extendlib.extend_dangles(lines)
+    assert (ext['xtype'] == NULL).all()
+    assert np.isinf(ext['dist']).all()
+    assert (ext['ex'] == ext['x']).all() and (ext['ey'] == ext['y']).all()
+
+
+def test_overshoot():
+    lines = [line((0, 0), (100, 0)), line((50, 10), (50, 100))]
+    r = row(extendlib.extend_dangles(lines), 1, HEAD)
+    assert (r['ex'], r['ey']) == pytest.approx((50, -extendlib.OVERSHOOT))
+    r = row(extendlib.extend_dangles(lines, overshoot=2), 1, HEAD)
+    assert (r['ex'], r['ey']) == pytest.approx((50, -2))
+
+
+def test_empty_lines():
+    # Lines without vertices are skipped, the others keep their indices
+    lines = [np.zeros((0, 2)), line((0, 0), (100, 0)), np.zeros((0, 2)), line((50, 10), (50, 100))]
+    ext = extendlib.extend_dangles(lines, overshoot=0)
+    assert set(ext['line']) == {1, 3}
+    r = row(ext, 3, HEAD)
+    assert r['xtype'] == ORIG and r['other'] == 1
+    out = extendlib.extend_coords(lines, overshoot=0)
+    assert len(out[0]) == 0 and len(out[2]) == 0
+    assert out[3].tolist() == [[50, 0], [50, 10], [50, 100]]
+    assert out[1].tolist() == lines[1].tolist()
+
+
+def test_empty_list_lines():
+    # As shapely gives for an empty LineString
+    lines = [[(0, 0), (100, 0)], [], [(50, 10), (50, 100)]]
+    ext = extendlib.extend_dangles(lines, overshoot=0)
+    assert row(ext, 2, HEAD)['other'] == 0
+    out = extendlib.extend_coords(lines, overshoot=0)
+    assert out[1].shape == (0, 2)
+    assert out[2].tolist() == [[50, 0], [50, 10], [50, 100]]
+    xy, offsets = extendlib.pack_lines(lines)
+    assert offsets.tolist() == [0, 2, 2, 4]
+
+
+def test_snap_splits():
+    # The line met is split at the hit point, which ends all three lines
+    xy, offsets = extendlib.pack_lines([line((0, 0), (100, 0)), line((50, 10), (50, 100))])
+    ids = np.arange(2)
+    dangles, length, best = extendlib.extend_lines(xy, offsets, ids, ids)
+    changed, coords = extendlib.snap_lines(xy, offsets, ids, ids, dangles, best)
+    assert changed.tolist() == [0, 1]
+    assert [c.tolist() for c in coords[0]] == [[[0, 0], [50, 0]], [[50, 0], [100, 0]]]
+    assert [c.tolist() for c in coords[1]] == [[[50, 0], [50, 10], [50, 100]]]
+
+
+def test_snap_nodes():
+    # After snapping, every 'orig' and 'ext' end shares a node: the only
+    # dangles left are those that extended nowhere
+    xy, offsets = paddocks(5000, seed=2, crossing=0.2)
+    ids = np.arange(len(offsets) - 1)
+    dangles, length, best = extendlib.extend_lines(xy, offsets, ids, ids)
+    changed, coords = extendlib.snap_lines(xy, offsets, ids, ids, dangles, best)
+    keep = np.setdiff1d(ids, changed)
+    lines = [xy[offsets[j]:offsets[j + 1]] for j in keep] + [c for parts in coords for c in parts]
+    nxy, noff = extendlib.pack_lines(lines)
+    n = np.arange(len(lines))
+    left = extendlib.find_dangles(nxy, noff, n, n)
+    ends = np.concatenate([nxy[noff[:-1]], nxy[noff[1:] - 1]])
+    pts, degree = np.unique(ends, axis=0, return_counts=True)
+    orig = best['xtype'] == ORIG
+    at = [np.flatnonzero((pts[:, 0] == x) & (pts[:, 1] == y)) for x, y in zip(best['x'][orig], best['y'][orig])]
+    assert all(len(a) == 1 and degree[a[0]] >= 3 for a in at)
+    null = dangles[best['xtype'] == NULL]
+    assert sorted(zip(left['x'], left['y'])) == sorted(zip(null['x'], null['y']))
+
+
+def test_line_hashes():
+    # Equal lines hash equal; a moved, reversed or dropped vertex changes it
+    xy, offsets = extendlib.pack_lines([line((0, 0), (1, 1), (2, 0)), line((0, 0), (1, 1), (2, 0)),
+                                        line((0, 0), (1, 1 + 1e-9), (2, 0)), line((2, 0), (1, 1), (0, 0)),
+                                        line((0, 0), (1, 1)), []])
+    h = extendlib.line_hashes(xy, offsets)
+    assert h.dtype == np.int64
+    assert h[0] == h[1]
+    assert len(set(h[[0, 2, 3, 4, 5]].tolist())) == 5
+
+
+
+def same(a, b):
+    # The same choice for every dangle, to the bit
+    for field in ('xtype', 'other', 'x', 'y'):
+        np.testing.assert_array_equal(a[field], b[field])
+
+
+def tie_grid(n=40, cell=100.0, cut=0.3, gap=10.0, seed=0):
+    """Packed lines of a regular grid of two-vertex edges, some cut back by
+    gap from a node (all four at crossroads), in random order. Every ray
+    runs exactly through a node, so hits tie exactly: on the lines meeting
+    at the node, and between the extensions of a crossroads."""
+    rng = np.random.default_rng(seed)
+    cross = rng.random((n + 1, n + 1)) < cut / 3
+    lines = []
+    for i in range(n + 1):
+        for j in range(n + 1):
+            for di, dj in ((0, 1), (1, 0)):
+                if i + di > n or j + dj > n:
+                    continue
+                d = np.array([dj, di], dtype=np.float64)
+                a = np.array([j, i]) * cell
+                b = a + d * cell
+                if cross[i, j] or rng.random() < cut / 2:
+                    a = a + d * gap
+                if cross[i + di, j + dj] or rng.random() < cut / 2:
+                    b = b - d * gap
+                lines.append(np.array([a, b]))
+    return extendlib.pack_lines([lines[k] for k in rng.permutation(len(lines))])
+
+
+@pytest.mark.parametrize('network', ['paddocks', 'ties0', 'ties1'])
+def test_tiled_equals_single(network):
+    # Tiles, each with its halo, give what one run over all the lines does,
+    # ties included (broken by line id and dangle key, not grid order)
+    if network == 'paddocks':
+        xy, offsets = paddocks(20000, seed=7, crossing=0.3)
+    else:
+        xy, offsets = tie_grid(seed=int(network[-1]))
+    ids = np.arange(1, len(offsets))
+    one = extendlib.extend_lines(xy, offsets, ids, ids)
+    tiled = extendlib.extend_tiled(xy, offsets, ids, ids, nprocs=4)
+    np.testing.assert_array_equal(one[0], tiled[0])
+    same(one[2], tiled[2])
+
+
+@pytest.mark.parametrize('network', ['paddocks', 'ties0'])
+def test_sweep_equals_separate_runs(network):
+    # Each combination of a sweep resolves as a run of its own would
+    if network == 'paddocks':
+        xy, offsets = paddocks(20000, seed=7, crossing=0.3)
+    else:
+        xy, offsets = tie_grid(seed=0)
+    ids = np.arange(1, len(offsets))
+    combos = [(m, s) for m in (30, 100, 200) for s in (0, 0.25, 0.5)]
+    dangles, results = extendlib.sweep(xy, offsets, ids, ids, combos=combos)
+    for (maxlen, scale), (length, best) in zip(combos, results):
+        one = extendlib.extend_lines(xy, offsets, ids, ids, maxlen=maxlen, scale=scale)
+        np.testing.assert_array_equal(one[0], dangles)
+        np.testing.assert_array_equal(one[1], length)
+        same(one[2], best)
@@ -0,0 +1,94 @@
+"""
+Peak memory of the streamed, tile by tile extension (quad_tiles() and
+extend_core(), as v.extendline -s runs them) must not grow with the map.
+
+The map is a K x K repeat of one synthetic paddock block, generated once:
+counting and reading a tile only touch the blocks under it, so nothing but
+the tiles being worked on is ever held. Each size runs in a fresh process
+so its peak RSS is its own.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import extendlib
+import extendprof
+from paddocks import paddocks
+
+BLOCK = 10000       # Lines per block
+LIMIT = 20000       # Lines per tile, as the memory budget would give
+MAXLEN = 200.0
+
+
+class Repeat(object):
+    """A k x k map of copies of one block of packed lines."""
+
+    def __init__(self, k):
+        self.k = k
+        self.xy, self.offsets = paddocks(BLOCK, seed=1)
+        self.boxes = np.column_stack(extendlib.line_boxes(self.xy, self.offsets))
+        self.period = self.boxes[:, 2:].max() + 200.0
+        self.extent = (self.boxes[:, 0].min(), self.boxes[:, 1].min(),
+                       self.boxes[:, 2].max() + (k - 1) * self.period,
+                       self.boxes[:, 3].max() + (k - 1) * self.period)
+
+    def blocks(self, x0, y0, x1, y1):
+        # Blocks under the box, with the lines of each whose box it meets
+        for j in range(max(int((y0 - self.period) // self.period), 0), min(int(y1 // self.period) + 1, self.k)):
+            for i in range(max(int((x0 - self.period) // self.period), 0), min(int(x1 // self.period) + 1, self.k)):
+                dx, dy = i * self.period, j * self.period
+                b = self.boxes
+                sel = np.flatnonzero((b[:, 2] + dx >= x0) & (b[:, 0] + dx <= x1) &
+                                     (b[:, 3] + dy >= y0) & (b[:, 1] + dy <= y1))
+                if len(sel):
+                    yield j * self.k + i, dx, dy, sel
+
+    def count(self, x0, y0, x1, y1):
+        return sum(len(sel) for _, _, _, sel in self.blocks(x0, y0, x1, y1))
+
+    def read(self, x0, y0, x1, y1):
+        xys, offs, ids = [], [], []
+        for block, dx, dy, sel in self.blocks(x0, y0, x1, y1):
+            xy, off = extendlib._subset(self.xy, self.offsets, sel)
+            xys.append(xy + (dx, dy))
+            offs.append(np.diff(off))
+            ids.append(block * BLOCK + sel + 1)
+        if not xys:
+            return np.zeros((0, 2)), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        nv = np.concatenate(offs)
+        return np.concatenate(xys), np.r_[0, np.cumsum(nv)].astype(np.int64), np.concatenate(ids)
+
+
+def stream(k):
+    """Extend a k x k map tile by tile; returns (dangles, peak RSS in MB)."""
+    src = Repeat(k)
+    halo = 4 * MAXLEN
+    depth = int(np.ceil(np.log(max(k * k * BLOCK / float(LIMIT), 1.0)) / np.log(4)))
+    dangles = 0
+    for core in extendlib.quad_tiles(*src.extent, halo=halo, count=src.count, limit=LIMIT, depth=depth):
+        xy, offsets, ids = src.read(core[0] - halo, core[1] - halo, core[2] + halo, core[3] + halo)
+        d, length, best, partner = extendlib.extend_core(core, xy, offsets, ids, ids, None, MAXLEN, 0.5)
+        dangles += len(d)
+    return dangles, extendprof._peak_rss()
+
+
+def run(k):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), str(k)],
+                         stdout=subprocess.PIPE, check=True, env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    return json.loads(out.stdout)
+
+
+def test_peak_memory_flat():
+    small = run(3)      # 90k lines
+    large = run(10)     # 1M lines
+# Every dangle is owned by one tile, so they scale with the map
+    assert abs(large['dangles'] / float(small['dangles']) - 100 / 9.0) < 100 / 9.0 * 0.05
+    assert large['peak_rss_mb'] < small['peak_rss_mb'] * 1.25 + 20
+
+
+if __name__ == '__main__':
+    dangles, peak = stream(int(sys.argv[1]))
+    json.dump({'dangles': dangles, 'peak_rss_mb': peak}, sys.stdout)
@@ -26,7 +26,73 @@
 #%option G_OPT_V_INPUT
 #% key: map
 #% description: Input vector map with dangles to extend
-#% required: yes
+#% required: no
+#%end
+
+#%option G_OPT_V_INPUTS
+#% key: maps
+#% description: Input vector maps to extend in one batch, each into <map><suffix>
+#% required: no
+#% guisection: Batch
+#%end
+
+#%option
+#% key: pattern
+#% type: string
+#% description: Batch of input vector maps to extend, as a g.list pattern
+#% required: no
+#% guisection: Batch
+#%end
+
+#%option
+#% key: suffix
+#% type: string
+#% description: Suffix of the output map names in a batch
+#% answer: _ext
+#% required: no
+#% guisection: Batch
+#%end
+
+#%option
+#% key: input
+#% type: string
+#% key_desc: name
+#% description: OGR datasource (e.g. GeoPackage) to read lines from directly, instead of a map
+#% required: no
+#% guisection: OGR
+#%end
+
+#%option
+#% key: layer
+#% type: string
+#% description: Layer of the OGR input (def=first layer)
+#% required: no
+#% guisection: OGR
+#%end
+
+#%option
+#% key: output
+#% type: string
+#% key_desc: name
+#% description: OGR datasource to write the extended lines of input to
+#% required: no
+#% guisection: OGR
+#%end
+
+#%option
+#% key: output_layer
+#% type: string
+#% description: Layer of the OGR output (def=name of the input layer)
+#% required: no
+#% guisection: OGR
+#%end
+
+#%option
+#% key: format
+#% type: string
+#% description: OGR format of the output, if it is created (def=GPKG)
+#% required: no
+#% guisection: OGR
 #%end
 
 #%option G_OPT_V_OUTPUT
@@ -39,388 +105,1235 @@
 #%option
 #% key: maxlen
 #% type: integer
-#% description: Max length in map units that line can be extended (def=200)
+#% description: Max length in map units that line can be extended (def=200), several for a sweep
 #% required: no
+#% multiple: yes
 #% guisection: Output
 #%end
 
 #%option
 #% key: scale
 #% type: double
-#% description: Maximum length of extension as proportion of original line, disabled if 0 (def=0.5)
+#% description: Maximum length of extension as proportion of original line, disabled if 0 (def=0.5), several for a sweep
+#% required: no
+#% multiple: yes
+#% guisection: Output
+#%end
+
+#%option
+#% key: passes
+#% type: integer
+#% description: Passes of extension, later ones extending dangles left over to the extensions made, 0 until no more extend (def=1)
+#% required: no
+#%end
+
+#%option
+#% key: method
+#% type: string
+#% options: engine,vdistance
+#% description: Intersection search, built-in engine or v.distance (for cross-checking) (def=engine)
+#% required: no
+#%end
+
+#%option
+#% key: scan
+#% type: string
+#% options: array,topo
+#% description: Dangle search, bulk endpoint count or node topology (def=array)
+#% required: no
+#%end
+
+#%option G_OPT_M_NPROCS
+#% description: Number of processes, each working on spatial tiles of the map (def=1)
+#%end
+
+#%option
+#% key: jobs
+#% type: integer
+#% description: Number of independent pipeline stages (map copy, v.distance searches) run at once (def=2)
+#% required: no
+#%end
+
+#%option G_OPT_MEMORYMB
+#% description: Memory budget in MB when streaming (-s) (def=300)
+#%end
+
+#%option
+#% key: state
+#% type: string
+#% key_desc: name
+#% description: File keeping dangles and extensions between runs; if it exists, only changes since are redone and patched into map_out
+#% required: no
+#% guisection: Output
+#%end
+
+#%option
+#% key: index
+#% type: string
+#% key_desc: name
+#% description: Directory for a memory-mapped spatial index of the input lines, rebuilt only when the map changes
+#% required: no
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: stats
+#% description: JSON file for the statistics of each maxlen and scale combination of a sweep
 #% required: no
 #% guisection: Output
 #%end
 
+#%option G_OPT_F_OUTPUT
+#% key: profile
+#% description: JSON file for the time and memory used by each stage (implies -p)
+#% required: no
+#%end
+
+#%flag
+#% key: s
+#% description: Stream the map tile by tile, keeping memory use within the memory budget
+#%end
+
+#%flag
+#% key: p
+#% description: Report time, CPU and memory used by each stage
+#%end
+
+#%flag
+#% key: n
+#% description: Snap extensions exactly onto the lines they meet, splitting those lines at the hit point
+#%end
+
 #%flag
 #% key: d
 #% description: Provides additional debug messages and output
 #%end
 
+#%rules
+#% required: map,maps,pattern,input
+#% exclusive: map,maps,pattern,input
+#% requires: input,output
+#% requires: output,input
+#%end
+
 import os
 import sys
 import atexit
+import json
 import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import groupby
 import grass.script as grass
 
 from grass.script import run_command
 from grass.pygrass.vector import VectorTopo
 from grass.pygrass.vector import geometry as geo
-from grass.pygrass.vector.table import get_path, Table, Columns
+from grass.pygrass.vector.basic import Bbox
+from grass.pygrass.vector.table import Table, Columns
+from grass.script.utils import set_path
+from grass.exceptions import CalledModuleError
+from grass.lib import vector as libvect
 import sqlite3
-path="$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db"
-import gc
+import platform
+import re
+import numpy as np
+try:
+    from osgeo import ogr
+except ImportError:
+    ogr = None
+
+set_path('v.extendline')
+import extendlib
+import extendprof
+
+# Table of the scratch map "extend" of potential extensions, one per dangle
+EXTEND_COLS = [(u'cat',        'INTEGER PRIMARY KEY'),
+               (u'parent',     'INTEGER'),
+               (u'dend',       'TEXT'),
+               (u'orgx',       'DOUBLE PRECISION'),
+               (u'orgy',       'DOUBLE PRECISION'),
+               (u'search_len', 'DOUBLE PRECISION'),
+               (u'search_az',  'DOUBLE PRECISION'),
+               (u'best_xid',   'INTEGER'),
+               (u'near_x',     'DOUBLE PRECISION'),
+               (u'near_y',     'DOUBLE PRECISION'),
+               (u'other_cat',  'INTEGER'),
+               (u'xtype',      'TEXT'),
+               (u'x_len',      'DOUBLE PRECISION')]
+
+# Per-run scratch state. Temporary maps get a suffix unique to this run (host,
+# process and the run's number in it, as a batch worker makes many runs) and
+# tables go in a database of their own, so runs in one mapset don't collide.
+# The connection is shared by pipeline stages in threads, taking lock in turn.
+scratch = {'suffix': '', 'db': None, 'conn': None, 'lock': threading.RLock(), 'maps': [], 'keep': False,
+           'runs': 0}
+
+def scratchSetup():
+#
+# Set up the names and database for this run's intermediate results
+#
+    scratch['runs'] += 1
+    scratch['suffix'] = "_{}_{}_{}".format(re.sub(r'\W', '_', platform.node().split('.')[0]), os.getpid(),
+                                           scratch['runs'])
+    scratch['db'] = grass.tempfile()
+    scratch['conn'] = None
+    scratch['maps'] = []
+    scratch['keep'] = False
+
+def scratchMap(name):
+#
+# This run's name for temporary map name, removed by cleanup()
+#
+    name = name + scratch['suffix']
+    scratch['maps'].append(name)
+    return name
+
+def scratchConnect(conn=None):
+#
+# The run's one connection to the scratch database, opened on first use (or
+# tune conn if given, e.g. one opened by pygrass). WAL lets other readers
+# such as v.in.db in while it writes, and nothing in it needs to survive a
+# crash, so durability is traded for speed. SQLite has no sqrt(), so it is
+# registered here.
+#
+    if conn is None:
+        if scratch['conn'] is not None:
+            return scratch['conn']
+        conn = scratch['conn'] = sqlite3.connect(scratch['db'], check_same_thread=False)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -65536")
+    conn.create_function('sqrt', 1, lambda v: None if v is None else math.sqrt(v))
+    return conn
 
 def cleanup():
-    pass
+    if scratch['keep']:
+        return
+    for name in scratch['maps']:
+        if grass.find_file(name, element='vector')['file']:
+            run_command("g.remove", flags = 'f', quiet = True, type = "vector", name = name)
+    scratch['maps'] = []
+    if scratch['conn'] is not None:
+        scratch['conn'].close()
+        scratch['conn'] = None
+    for ext in ('', '-wal', '-shm'):
+        if scratch['db'] and os.path.exists(scratch['db'] + ext):
+            os.remove(scratch['db'] + ext)
+    scratch['db'] = None
 
-def extendLine(map, map_out, maxlen=200, scale=0.5, debug=False, verbose=1):
+class Stages(object):
+#
+# A small dependency graph of pipeline stages. Each stage added starts in a
+# thread once the stages it needs have finished, at most jobs at a time; the
+# heavy ones are GRASS modules in subprocesses, so threads overlap them fine.
+# With jobs=1 there are no threads: each stage runs as soon as it is added
+# (or its needs finish), before the caller goes on. A stage whose needs
+# failed fails with the same error. Stage wall times go to prof, with the
+# result of func as the item count if unit is given.
+#
+    def __init__(self, jobs=2, prof=extendprof.NOPROF):
+        self.pool = ThreadPoolExecutor(jobs) if jobs > 1 else None
+        self.prof = prof
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.waiting = []
+
+    def add(self, name, func, needs=(), unit=None):
+        fut = self.futures[name] = Future()
+        with self.lock:
+            self.waiting.append((name, func, [self.futures[n] for n in needs], unit, fut))
+        fut.add_done_callback(self.start)
+        self.start()
+        return fut
+
+    def start(self, done=None):
+        with self.lock:
+            ready = [s for s in self.waiting if all(f.done() for f in s[2])]
+            self.waiting = [s for s in self.waiting if s not in ready]
+        for name, func, needs, unit, fut in ready:
+            failed = [f.exception() for f in needs if f.exception() is not None]
+            if failed:
+                fut.set_exception(failed[0])
+            elif self.pool is None:
+                self.run(name, func, unit, fut)
+            else:
+                self.pool.submit(self.run, name, func, unit, fut)
+
+    def run(self, name, func, unit, fut):
+        begin = time.time()
+        try:
+            res = func()
+        except BaseException as e:
+            fut.set_exception(e)
+            return
+        self.prof.add(name, time.time() - begin, res if unit else None, unit)
+        fut.set_result(res)
+
+    def result(self, name):
+        return self.futures[name].result()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+def keepScratch():
+#
+# Debugging - leave the intermediate maps and tables for inspection
+#
+    scratch['keep'] = True
+    grass.info("Keeping maps {} and scratch database {}".format(", ".join(scratch['maps']), scratch['db']))
+
+def extendLine(map, map_out, maxlen=200, scale=0.5, debug=False, verbose=1, method='engine', scan='array', nprocs=1,
+               stream=False, memory=300, profile=False, profile_out=None, state=None, index=None, passes=1, snap=False, jobs=2):
 #
 # map=Input map name
 # map_out=Output map with extensions
 # maxlen=Max length in map units that line can be extended (def=200)
 # scale=Maximum length of extension as proportion of original line, disabled if 0 (def=0.5)
+# method=Intersection search, 'engine' (extendlib) or 'vdistance' (def=engine)
+# scan=Dangle search, 'array' (endpoint count) or 'topo' (node topology) (def=array)
+# nprocs=Number of processes, splitting the map into tiles (def=1)
+# stream=Process the map tile by tile within a memory budget (def=False)
+# memory=Memory budget in MB for stream (def=300)
+# profile=Report time, CPU and memory used by each stage (def=False)
+# profile_out=JSON file for the stage report, implies profile (def=None)
+# state=File keeping dangles and extensions for incremental re-runs into map_out (def=None)
+# index=Directory for a spatial index of the map's lines, reused while it is unchanged (def=None)
+# passes=Passes of extension, 0 to repeat until nothing more extends (def=1)
+# jobs=Independent stages (map copy, v.distance searches) run at once (def=2)
+# snap=End extensions on their hit point and split the line met there, rather than overshoot (def=False)
 # vlen=number of verticies to look back in calculating line end direction (def=1)
 # Not sure if it is worth putting this in as parameter.
 #
     allowOverwrite = os.getenv('GRASS_OVERWRITE', '0') == '1'
-    grass.info("map={}, map_out={}, maxlen={}, scale={}, debug={}".format(map, map_out, maxlen, scale, debug))
+    core = method == 'engine' and scan == 'array'   # Everything done by extendlib
+    if nprocs > 1 and (stream or not core):
+        grass.warning("nprocs>1 needs method=engine and scan=array without -s, running on one process")
+    if stream and method != 'engine':
+        grass.warning("Streaming (-s) always uses method=engine")
+    if state and (stream or not core or not map_out):
+        grass.warning("state needs map_out, method=engine and scan=array without -s, ignoring it")
+        state = None
+    if passes != 1 and (stream or state):
+        grass.warning("passes needs a run without -s or state, making one pass")
+        passes = 1
+    if snap and (stream or state or scan != 'array'):
+        grass.warning("-n needs scan=array without -s or state, overshooting instead")
+        snap = False
+    if index and (stream or not core):
+        grass.warning("index needs method=engine and scan=array without -s, ignoring it")
+        index = None
+    grass.info("map={}, map_out={}, maxlen={}, scale={}, debug={}, method={}, scan={}, nprocs={}, stream={}".format(map, map_out, maxlen, scale, debug, method, scan, nprocs, stream))
+    prof = extendprof.Profiler() if profile or profile_out else extendprof.NOPROF
+    run = dict(map=map, map_out=map_out, maxlen=maxlen, scale=scale, method=method, scan=scan,
+               nprocs=nprocs, stream=stream, memory=memory, snap=snap, jobs=jobs)
     vlen = 1 # not sure if this is worth putting in as parameter
-    cols = [(u'cat',        'INTEGER PRIMARY KEY'),
-            (u'parent',     'INTEGER'),
-            (u'dend',       'TEXT'),
-            (u'orgx',       'DOUBLE PRECISION'),
-            (u'orgy',       'DOUBLE PRECISION'),
-            (u'search_len', 'DOUBLE PRECISION'),
-            (u'search_az',  'DOUBLE PRECISION'),
-            (u'best_xid',   'INTEGER'),
-            (u'near_x',     'DOUBLE PRECISION'),
-            (u'near_y',     'DOUBLE PRECISION'),
-            (u'other_cat',  'INTEGER'),
-            (u'xtype',      'TEXT'),
-            (u'x_len',      'DOUBLE PRECISION')]
-    extend=VectorTopo('extend')
-    if extend.exist():
-        extend.remove()
-    extend.open('w', tab_name = 'extend', tab_cols = cols)
+    scratchSetup()
+    if stream:
+        res = extendStream(map, map_out, maxlen, scale, vlen, memory, debug, allowOverwrite, prof)
+        if res == 0:
+            profileReport(prof, profile_out, run)
+        return res
+    featureCnt, nonLines, xy, offsets, fids, cats, isLine, dangles, lineIndex = \
+        readLines(map, index, maxlen, method, scan, vlen, prof)
+    if state:
+#
+# Incremental run - only redo the dangles near features changed since the
+# run that saved state, and patch map_out
+#
+        hashes = extendlib.line_hashes(xy, offsets)
+        fids = np.asarray(fids, dtype=np.int64)
+        cats = np.asarray(cats, dtype=np.int64)
+        isLine = np.asarray(isLine, dtype=bool)
+        boxes = np.column_stack(extendlib.line_boxes(xy, offsets)) if len(fids) else np.zeros((0, 4))
+        old = loadState(state, run)
+        lineCats = cats[isLine]
+        if old is not None and (lineCats.min(initial=0) < 0 or len(np.unique(lineCats)) < len(lineCats)):
+            grass.warning("Incremental runs need a unique cat on every line, redoing the whole map")
+            old = None
+        if old is not None:
+            extendIncremental(map, map_out, state, run, old, xy, offsets, fids, cats, isLine, hashes, boxes,
+                              maxlen, scale, vlen, prof)
+            profileReport(prof, profile_out, run)
+            cleanup()
+            return 0
+# Tile workers are forked before the stage threads start, so none of them
+# can inherit a lock a thread holds
+    tilePool = multiprocessing.Pool(nprocs) if core and nprocs > 1 else None
+# The copy to map_out only has to be done by the rewrite, so runs alongside
+    stages = Stages(jobs, prof)
+    stages.add('copy', lambda: outputMap(map, map_out, allowOverwrite))
+    if core:
+# Dangles, intersects and the choice between them, in tiles if nprocs>1
+        if nprocs > 1:
+            grass.info("Searching for dangles and intersects in tiles with {} processes".format(nprocs))
+        try:
+            dangles, extLen, best = extendlib.extend_tiled(xy, offsets, fids, cats, isLine, maxlen, scale, vlen,
+                                                           nprocs, prof, lineIndex, tilePool)
+        finally:
+            if tilePool is not None:
+                tilePool.terminate()
+        extendPasses(dangles, extLen, best, passes, prof)
+    else:
+        prof.begin('dangles')
+        if scan == 'array':
+            dangles = extendlib.find_dangles(xy, offsets, fids, cats, isLine, vlen)
+        else:
+            dangles = np.array(dangles, dtype=extendlib.DANGLE_DTYPE)
+        extLen = extendlib.search_length(dangles['length'], maxlen, scale)
+        best = None
+        prof.end(len(fids), 'lines')
+    dangleCnt = len(dangles)
+    grass.info("{} dangle nodes found".format(dangleCnt))
+# The potential extensions are held in dangles, extLen and best. Only
+# v.distance and the debug output need them as a map.
+
+    if method == 'vdistance':
+#
+# For each dangle found, generate an extension line in the new map "extend"
+#
+        with prof.stage('write_extend', dangleCnt, 'dangles'):
+            extendMap = writeExtendMap(dangles, extLen)
+#
+# Create two tables where extensions intersect;
+# 1. intersect with original lines
+# 2. intersect with self - to extract intersects between extensions 
+#
+# The two v.distance searches, and the clean-up of each table, are independent
+# of each other. All SQL goes through the one scratch connection, a
+# transaction per step, under its lock.
+        conn = scratchConnect()
+        grass.info("Searching for intersects of potential extensions with original lines and each other")
+        prof.begin('vdistance')
+        stages.add('vdistance_orig', lambda: distanceTable(extendMap, map, 'isectIn'), unit='rows')
+        stages.add('vdistance_ext', lambda: distanceTable(extendMap, extendMap, 'isectX'), unit='rows')
+        stages.add('isect_orig', isectOrig, ['vdistance_orig'])
+        stages.add('isect_ext', isectExt, ['vdistance_ext'])
+        stages.add('ext_len', lambda: isectLengths(conn), ['isect_orig', 'isect_ext'], unit='rows')
+        rowCnt = stages.result('ext_len')
+        prof.end(rowCnt, 'rows')
+
+# Load all candidate intersects once, the closest to each origin is chosen in memory.
+# Extension cats are the dangle index+1, for both from_cat and 'ext' near_cat.
+        grass.info("Searching for closest intersect for each potential extension")
+        prof.begin('candidates')
+        cur=conn.execute("SELECT from_cat, near_cat, ntype, ext_len, nx, ny, rowid FROM isectIn")
+        cand=np.fromiter(((fc-1, nc-1 if nt == 'ext' else nc, extendlib.XTYPES.index(nt), ln, nx, ny, xid)
+                          for fc, nc, nt, ln, nx, ny, xid in cur),
+                         dtype=extendlib.CAND_DTYPE)
+        prof.end(len(cand), 'candidates')
+    elif not core:
+#
+# Built-in engine, nearest intersect of each extension with the original lines
+# and with the other extensions, all in memory
+#
+        grass.info("Searching for intersects of {} potential extensions".format(dangleCnt))
+        prof.begin('search')
+        x0, y0, x1, y1, owner = extendlib.line_segments(xy, offsets, isLine)
+        orig, ext = extendlib.nearest_hits(dangles['x'], dangles['y'], dangles['az'], extLen, dangles['line'],
+                                           x0, y0, x1, y1, np.asarray(fids)[owner], np.asarray(cats)[owner],
+                                           key=dangles['line']*2+dangles['dend'])
+        cand = extendlib.hit_candidates(orig, ext)
+        del x0, y0, x1, y1, owner, orig, ext
+        prof.end(dangleCnt, 'dangles')
+#
+# Choose the intersect for each extension, letting the jilted re-search,
+# and write all choices to table extend in one pass
+#
+    if best is None:
+        prof.begin('resolve')
+        best = extendlib.resolve(cand, dangleCnt)
+        prof.end(len(cand), 'candidates')
+        extendPasses(dangles, extLen, best, passes, prof)
+        del cand
+    if method == 'vdistance':
+        grass.verbose("Updating table extend")
+        prof.begin('update_extend')
+        table_extend = Table('extend',
+                    connection=scratchConnect())
+        xtype = best['xtype']
+        other = np.where(xtype == extendlib.EXT, best['other']+1, best['other'])  # Extension cats
+        with table_extend.conn:
+            table_extend.conn.executemany(
+                "UPDATE extend SET best_xid=?, x_len=?, near_x=?, near_y=?, other_cat=?, xtype=? WHERE cat=?",
+                ((int(best['xid'][i]), float(best['dist'][i]), float(best['x'][i]), float(best['y'][i]),
+                  int(other[i]), extendlib.XTYPES[xtype[i]], int(i)+1)
+                 for i in np.flatnonzero(xtype != extendlib.NULL)))
+        prof.end(dangleCnt, 'dangles')
+    elif debug:
+        with prof.stage('write_extend', dangleCnt, 'dangles'):
+            writeExtendMap(dangles, extLen, best)
+#
+# For debugging, create a map with the chosen intersect points
+#
+    if debug:
+        with prof.stage('chosen_map'):
+            chosenMap()
+#
+# Finally adjust the dangle lines in input map - use a copy (map_out) if requested
+#
+    map_out = stages.result('copy')
+    stages.close()
+    if not map_out:
+        return 1
+    if snap:
+        snapOutput(map_out, xy, offsets, fids, cats, isLine, dangles, best, nonLines, featureCnt, prof)
+    else:
+        mods, nx, ny, newFid = extendOutput(map_out, dangles, best, nonLines, featureCnt, prof)
+    if state:
+        ex = np.full(dangleCnt, np.nan)
+        ey = np.full(dangleCnt, np.nan)
+        ex[mods] = nx
+        ey[mods] = ny
+        outFid = np.where(isLine, [newFid.get(fid, fid) for fid in fids.tolist()], -1)
+        saveState(state, run, cats, isLine, hashes, boxes, outFid, dangles['cat']*2+dangles['dend'],
+                  dangles['x'], dangles['y'], ex, ey)
+    grass.message("v.extendlines completing")
+    profileReport(prof, profile_out, run)
+#
+# Clean up temporary tables and maps                    
+#
+    if debug:
+        keepScratch()
+    else:
+        cleanup()
+    return 0
+
+def readLines(map, index, maxlen, method, scan, vlen, prof):
+#
+# Read the lines of the map, or take them from its index if unchanged since.
+# Returns scanMap()'s results plus the index (None without one).
+#
+    dangles = []
+    lineIndex = None
+    if index:
+        stamp = mapStamp(map)
+        lineIndex = extendlib.load_index(index, stamp)
+    if lineIndex is not None:
+        grass.info("Reading the lines of map {} from index {}".format(map, index))
+        featureCnt, nonLines = lineIndex['features'], lineIndex['non_lines']
+        xy, offsets, fids, cats, isLine = (lineIndex[k] for k in ('xy', 'offsets', 'line', 'cat', 'is_line'))
+    else:
+        featureCnt, nonLines, xy, offsets, fids, cats, isLine, dangles = scanMap(map, method, scan, vlen, prof)
+# The index grid works for any search length, but is rebuilt if far off
+    if index and (lineIndex is None or not maxlen / 2.0 <= lineIndex['cell'] <= maxlen * 2.0):
+        grass.info("Saving index {} of map {}".format(index, map))
+        with prof.stage('index', len(fids), 'lines'):
+            lineIndex = extendlib.build_index(xy, offsets, fids, cats, isLine, maxlen,
+                                              stamp=stamp, features=featureCnt, non_lines=nonLines)
+            extendlib.save_index(index, lineIndex)
+    return featureCnt, nonLines, xy, offsets, fids, cats, isLine, dangles, lineIndex
+
+def extendBatch(maps, suffix, nprocs=1, **kw):
+#
+# Extend each of maps into <map><suffix> (the map itself if suffix is empty)
+# with extendLine(kw), nprocs maps at a time in a pool of long-lived worker
+# processes. A worker that dies (killed for memory, or a crash in a GRASS
+# library) breaks the pool: the maps not finished by then are reported as
+# failed rather than waited for. Reports the status and time of each map,
+# returns 1 if any failed.
+#
+    jobs = [(name, name.split('@')[0] + suffix if suffix else '', kw) for name in maps]
+    grass.info("Extending {} maps with {} processes".format(len(jobs), nprocs))
+    start = time.time()
+    if nprocs > 1 and len(jobs) > 1:
+        results = []
+        with ProcessPoolExecutor(nprocs) as pool:
+            futures = [pool.submit(batchJob, job) for job in jobs]
+            for (map, map_out, kw), fut in zip(jobs, futures):
+                try:
+                    results.append(fut.result())
+                except BrokenProcessPool:
+                    results.append((map, map_out or map, float('nan'), 'failed: worker process died'))
+    else:
+        results = [batchJob(job) for job in jobs]
+    lines = ["{:<30} {:<30} {:>10}  {}".format('map', 'map_out', 'time (s)', 'status')]
+    lines.extend("{:<30} {:<30} {:>10.2f}  {}".format(*row) for row in results)
+    failed = sum(1 for row in results if row[3] != 'ok')
+    grass.message("Batch results:\n" + "\n".join(lines))
+    grass.message("{} maps extended, {} failed, in {:.1f}s".format(len(results) - failed, failed, time.time() - start))
+    return 1 if failed else 0
+
+def batchJob(job):
+#
+# Extend one map of a batch, returning (map, map_out, seconds, status).
+# Each map gets its own subdirectory of an index directory. The worker lives
+# on to the next map and never runs the atexit hook, so the map's scratch
+# maps and database are removed here however it ends, grass.fatal() included.
+#
+    map, map_out, kw = job
+    if kw.get('index'):
+        kw = dict(kw, index=os.path.join(kw['index'], re.sub(r'\W', '_', map)))
+    start = time.time()
+    try:
+        status = 'ok' if extendLine(map, map_out, **kw) == 0 else 'failed'
+    except (Exception, SystemExit) as e:
+        status = 'failed: {}'.format(e)
+    finally:
+        cleanup()
+    return map, map_out or map, time.time() - start, status
+
+def extendOgr(input, layer, output, output_layer=None, format='GPKG', maxlen=200, scale=0.5, nprocs=1,
+              passes=1, snap=False, profile=False, profile_out=None):
+#
+# Extend the lines of an OGR layer straight into an OGR output layer, with no
+# import into the mapset and no topology. Geometries are read once to find
+# dangles and intersects in memory, then features are streamed from input to
+# output with their attributes, the geometry of extended lines replaced. Each
+# part of a multi-line is a line of its own, with the feature id as its cat.
+# Only line features are written, as for a map.
+#
+    if ogr is None:
+        grass.fatal("OGR input and output need the GDAL Python bindings (osgeo)")
+    ogr.UseExceptions()
+    allowOverwrite = os.getenv('GRASS_OVERWRITE', '0') == '1'
+    prof = extendprof.Profiler() if profile or profile_out else extendprof.NOPROF
+    run = dict(input=input, layer=layer, output=output, output_layer=output_layer, maxlen=maxlen, scale=scale,
+               nprocs=nprocs, passes=passes, snap=snap)
+    vlen = 1
+    src = ogr.Open(input)
+    inLayer = src.GetLayerByName(layer) if layer else src.GetLayer(0)
+    if inLayer is None:
+        grass.fatal("No layer {} in {}".format(layer, input))
+# Features are streamed from the input layer while the output is written, so
+# the output layer cannot replace it
+    output_layer = output_layer or inLayer.GetName()
+    if output_layer == inLayer.GetName() and os.path.realpath(output) == os.path.realpath(input):
+        grass.fatal("Layer {} of {} is the input, give another output_layer or output".format(output_layer, output))
+    defn = inLayer.GetLayerDefn()
+    grass.info("Reading lines of layer {} from {}".format(inLayer.GetName(), input))
+    with prof.stage('scan') as rec:
+        inLayer.SetIgnoredFields([defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())])
+        coords = []
+        cats = []
+        for feat in inLayer:
+            for k, part in lineParts(feat.GetGeometryRef()):
+                coords.append(np.array(part.GetPoints(), dtype=np.float64)[:, :2])
+                cats.append(feat.GetFID())
+        inLayer.SetIgnoredFields([])
+        inLayer.ResetReading()
+        rec['items'], rec['unit'] = len(coords), 'lines'
+    xy, offsets = extendlib.pack_lines(coords)
+    del coords
+    lines = np.arange(len(cats), dtype=np.int64)
+    cats = np.asarray(cats, dtype=np.int64)
+    dangles, extLen, best = extendlib.extend_tiled(xy, offsets, lines, cats, None,
+                                                   maxlen, scale, vlen, nprocs, prof)
+    extendPasses(dangles, extLen, best, passes, prof)
+    grass.info("{} dangle nodes found".format(len(dangles)))
+# New coordinates of the lines that change
+    if snap:
+        with prof.stage('snap', len(dangles), 'dangles'):
+            changed, newCoords = extendlib.snap_lines(xy, offsets, lines, cats, dangles, best)
+        newLines = dict(zip(changed.tolist(), newCoords))
+    else:
+        mods, nx, ny = extendlib.new_ends(dangles, best)
+        newLines = {}
+        for j, dend, x, y in zip(dangles['line'][mods].tolist(), dangles['dend'][mods].tolist(),
+                                 nx.tolist(), ny.tolist()):
+            c = newLines.get(j, [xy[offsets[j]:offsets[j+1]]])[0]
+            newLines[j] = [np.concatenate([[(x, y)], c]) if dend == extendlib.HEAD else np.concatenate([c, [(x, y)]])]
+    grass.info("Writing {} features, {} lines changed, to {}".format(inLayer.GetFeatureCount(), len(newLines), output))
+    with prof.stage('write') as rec:
+        rec['items'], rec['unit'] = writeOgr(inLayer, output, output_layer, format,
+                                             newLines, allowOverwrite), 'features'
+    grass.message("v.extendlines completing")
+    profileReport(prof, profile_out, run)
+    return 0
+
+def lineParts(geom):
+#
+# The line strings of an OGR geometry with at least two points, as (k, line):
+# itself (k=0), or the parts of a multi-line with their index k. Anything else
+# has none.
+#
+    if geom is None:
+        return []
+    kind = ogr.GT_Flatten(geom.GetGeometryType())
+    if kind == ogr.wkbLineString:
+        parts = [(0, geom)]
+    elif kind == ogr.wkbMultiLineString:
+        parts = [(k, geom.GetGeometryRef(k)) for k in range(geom.GetGeometryCount())]
+    else:
+        return []
+    return [(k, part) for k, part in parts if part.GetPointCount() > 1]
+
+def writeOgr(inLayer, output, name, format, newLines, allowOverwrite, batch=100000):
+#
+# Stream the line features of inLayer into layer name of datasource output
+# (created as format if missing), with the parts numbered j in newLines given
+# their new 2D coordinates, a list of the pieces each is split into (see
+# newGeometry()). Parts are numbered as lineParts() yields them. Returns the
+# number of features written.
+#
+    if os.path.exists(output):
+        dst = ogr.Open(output, 1)
+    else:
+        dst = ogr.GetDriverByName(format or 'GPKG').CreateDataSource(output)
+    for k in range(dst.GetLayerCount()):
+        if dst.GetLayer(k).GetName() == name:
+            if not allowOverwrite:
+                grass.fatal("Layer {} exists in {}, use --o to overwrite it".format(name, output))
+            dst.DeleteLayer(k)
+            break
+    outLayer = dst.CreateLayer(name, inLayer.GetSpatialRef(), inLayer.GetGeomType())
+    defn = inLayer.GetLayerDefn()
+    for i in range(defn.GetFieldCount()):
+        outLayer.CreateField(defn.GetFieldDefn(i))
+    outDefn = outLayer.GetLayerDefn()
+    j = 0
+    written = 0
+    outLayer.StartTransaction()
+    for feat in inLayer:
+        geom = feat.GetGeometryRef()
+        parts = lineParts(geom)
+        if not parts:
+            continue
+        new = dict((k, newLines[j + n]) for n, (k, part) in enumerate(parts) if j + n in newLines)
+        pieces = []
+        if new:
+            geom, pieces = newGeometry(geom, new)
+            feat.SetGeometry(geom)
+        j += len(parts)
+        out = ogr.Feature(outDefn)
+        out.SetFrom(feat)
+        out.SetFID(feat.GetFID())
+        outLayer.CreateFeature(out)
+        written += 1
+        for piece in pieces:   # New features, with the same attributes
+            out = ogr.Feature(outDefn)
+            out.SetFrom(feat)
+            out.SetGeometry(piece)
+            outLayer.CreateFeature(out)
+            written += 1
+        if written % batch == 0:
+            outLayer.CommitTransaction()
+            outLayer.StartTransaction()
+    outLayer.CommitTransaction()
+    dst = None   # Closes and flushes the datasource
+    return written
+
+def newGeometry(geom, new):
+#
+# geom with its line parts k (as from lineParts()) replaced by the pieces
+# new[k], a list of coordinates, returned as (geometry, extra line strings).
+# A multi-line takes every piece as a part; a line takes the first and the
+# others are returned, to be written as features of their own.
+#
+    def lineString(c):
+        ln = ogr.Geometry(ogr.wkbLineString)
+        for x, y in c.tolist():
+            ln.AddPoint_2D(x, y)
+        return ln
+    if ogr.GT_Flatten(geom.GetGeometryType()) == ogr.wkbLineString:
+        return lineString(new[0][0]), [lineString(c) for c in new[0][1:]]
+    multi = ogr.Geometry(ogr.wkbMultiLineString)
+    for k in range(geom.GetGeometryCount()):
+        for ln in [lineString(c) for c in new[k]] if k in new else [geom.GetGeometryRef(k).Clone()]:
+            multi.AddGeometry(ln)
+    return multi, []
+
+def extendSweep(map, map_out, maxlens, scales, index=None, stats=None, profile=False, profile_out=None):
+#
+# Sweep every combination of the maxlen and scale values given, finding the
+# dangles and intersects once (extendlib.sweep()). Reports the number of
+# each intersect type and a histogram of extension lengths per combination,
+# also written to stats as JSON if given. With map_out, each combination is
+# also written to map <map_out>_m<maxlen>_s<scale>.
+#
+    allowOverwrite = os.getenv('GRASS_OVERWRITE', '0') == '1'
+    combos = [(m, sc) for m in maxlens for sc in scales]
+    grass.info("map={}, map_out={}, sweeping {} combinations of maxlen={} and scale={}".format(
+        map, map_out, len(combos), maxlens, scales))
+    prof = extendprof.Profiler() if profile or profile_out else extendprof.NOPROF
+    vlen = 1
+    scratchSetup()
+    featureCnt, nonLines, xy, offsets, fids, cats, isLine, dangles, lineIndex = \
+        readLines(map, index, max(maxlens), 'engine', 'array', vlen, prof)
+    dangles, results = extendlib.sweep(xy, offsets, fids, cats, isLine, combos, vlen, prof, lineIndex)
+    grass.info("{} dangle nodes found".format(len(dangles)))
+    edges = np.linspace(0, max(maxlens), 11)
+    table = []
+    for (m, sc), (extLen, best) in zip(combos, results):
+        xtype = best['xtype']
+        dist = best['dist'][xtype != extendlib.NULL]
+        row = dict(maxlen=m, scale=sc, dangles=len(dangles),
+                   mean_length=float(dist.mean()) if len(dist) else 0.0,
+                   bins=edges.tolist(), histogram=np.histogram(dist, bins=edges)[0].tolist())
+        row.update((name, int((xtype == i).sum())) for i, name in enumerate(extendlib.XTYPES))
+        if map_out:
+            row['map'] = re.sub(r'\W', '_', "{}_m{:g}_s{:g}".format(map_out, m, sc))
+            with prof.stage('copy'):
+                name = outputMap(map, row['map'], allowOverwrite)
+            if name:
+                extendOutput(name, dangles, best, nonLines, featureCnt, prof)
+        table.append(row)
+    lines = ["{:>10} {:>8} {:>10} {:>10} {:>10} {:>12}".format('maxlen', 'scale', 'orig', 'ext', 'null', 'mean length')]
+    lines.extend("{maxlen:>10g} {scale:>8g} {orig:>10} {ext:>10} {null:>10} {mean_length:>12.2f}".format(**row)
+                 for row in table)
+    grass.message("Sweep results:\n" + "\n".join(lines))
+    if stats:
+        with open(stats, 'w') as fh:
+            json.dump({'map': map, 'combinations': table}, fh, indent=2)
+    profileReport(prof, profile_out, dict(map=map, map_out=map_out, maxlen=maxlens, scale=scales))
+    cleanup()
+    return 0
+
+def extendPasses(dangles, extLen, best, passes, prof):
+#
+# Further passes extending the dangles left over to the extensions made
+#
+    if passes == 1:
+        return
+    before = int((best['xtype'] != extendlib.NULL).sum())
+    made = extendlib.extend_passes(dangles, extLen, best, passes, prof=prof)
+    grass.info("{} passes extended {} more dangles".format(
+        made, int((best['xtype'] != extendlib.NULL).sum()) - before))
+
+def scanMap(map, method, scan, vlen, prof):
 #
 # Go through input map, looking at each line and it's two nodes to find nodes
 # with only a single line starting/ending there - i.e. a dangle.
-# For each found, generate an extension line in the new map "extend"
+# With scan=array the line coordinates are read in one pass and the nodes
+# found from a count of line ends at each coordinate instead.
+# Returns (featureCnt, nonLines, xy, offsets, fids, cats, isLine, dangles),
+# dangles only being found here with scan=topo.
 #
+    prof.begin('scan')
     inMap = VectorTopo(map)
     inMap.open('r')
-    dangleCnt=0
-    tickLen=len(inMap)
+    featureCnt=len(inMap)
+    tickLen=featureCnt
     grass.info("Searching {} features for dangles".format(tickLen))
     ticker=0
+# Coordinates of lines (and boundaries, which count towards node degree)
+    coords=[]
+    fids=[]
+    cats=[]
+    isLine=[]
+    dangles=[]
+    nonLines=0
     grass.message("Percent complete...")
     for ln in inMap:
         ticker = (ticker + 1)
         grass.percent(ticker,tickLen,5)
+        if ln.gtype!=2:
+            nonLines=nonLines+1   # Not carried to the output map
         if ln.gtype==2: # Only process lines
+            if method == 'engine' or scan == 'array':
+                coords.append(ln.to_array())
+                fids.append(ln.id)
+                cats.append(-1 if ln.cat is None else ln.cat)
+                isLine.append(True)
+            if scan == 'array':
+                continue
             for nd in ln.nodes():
                 if nd.nlines == 1:   # We have a dangle
-                    dangleCnt=dangleCnt+1
                     vtx=min(len(ln)-1,vlen)
                     if len([1 for _ in nd.lines(only_out=True)])==1: # Dangle starting at node
-                        dend = "head"
+                        dend = extendlib.HEAD
                         sx = ln[0].x
                         sy = ln[0].y
                         dx = sx - ln[vtx].x
                         dy = sy - ln[vtx].y
                     else:                                            # Dangle ending at node
-                        dend = "tail"
+                        dend = extendlib.TAIL
                         sx = ln[-1].x
                         sy = ln[-1].y
                         dx = sx - ln[-(vtx+1)].x
                         dy = sy - ln[-(vtx+1)].y
                     endaz = math.atan2(dy,dx)
-                    if scale>0:
-                        extLen = min(ln.length() * scale, maxlen)
-                    else:
-                        extLen = maxlen
-                    ex = extLen*math.cos(endaz)+sx
-                    ey = extLen*math.sin(endaz)+sy
-                    extLine = geo.Line([(sx,sy),(ex,ey)])
-                    quiet=extend.write(extLine, (ln.cat,dend,sx,sy,extLen,endaz,0,0,0,0,'null',extLen))
-
-    grass.info("{} dangle nodes found, committing table extend".format(dangleCnt))
-    extend.table.conn.commit()
-    extend.close(build=True, release=True)
+                    dangles.append((ln.id,-1 if ln.cat is None else ln.cat,dend,sx,sy,endaz,ln.length()))
+        elif ln.gtype==4 and scan == 'array': # Boundaries only share nodes
+            coords.append(ln.to_array())
+            fids.append(ln.id)
+            cats.append(-1 if ln.cat is None else ln.cat)
+            isLine.append(False)
     inMap.close()
+    xy, offsets = extendlib.pack_lines(coords)
+    del coords
+    prof.end(featureCnt, 'features')
+    return featureCnt, nonLines, xy, offsets, fids, cats, isLine, dangles
 
+def extendStream(map, map_out, maxlen, scale, vlen, memory, debug, allowOverwrite, prof=extendprof.NOPROF):
 #
-# Create two tables where extensions intersect;
-# 1. intersect with original lines
-# 2. intersect with self - to extract intersects between extensions 
+# Streaming version of extendLine(), for maps too big to hold in memory.
+# The map is split into quadtree tiles holding about as many lines as fit in
+# the memory budget (MB). Each tile's lines (plus a 4 x maxlen halo) are read
+# through the spatial index, and the dangles it owns are written straight to
+# a "dangles" table (and the extend map if debugging). The rewrite then
+# streams the new ends from that table in feature id order.
 #
-# First the intersects with original lines
-    grass.info("Searching for intersects between potential extensions and original lines")
-    table_isectIn = Table('isectIn',
-                connection=sqlite3.connect(get_path(path)))
-    if table_isectIn.exist():
-        table_isectIn.drop(force=True)
-    run_command("v.distance",
-                flags = 'a',
-                overwrite = True,
-                quiet = True,
-                from_ = "extend",
-                from_type = "line",
-                to = map, 
-                to_type = "line",
-                dmax = "0",
-                upload = "cat,dist,to_x,to_y",
-                column = "near_cat,dist,nx,ny",
-                table = "isectIn")
-# Will have touched the dangle it comes from, so remove those touches
-    run_command("db.execute",
-                sql = "DELETE FROM isectIn WHERE rowid IN (SELECT isectIn.rowid FROM isectIn INNER JOIN extend ON from_cat=cat WHERE near_cat=parent)",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    run_command("db.execute",
-                sql = "ALTER TABLE isectIn ADD ntype VARCHAR",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    run_command("db.execute",
-                sql = "UPDATE isectIn SET ntype = 'orig' ",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
+    inMap = VectorTopo(map)
+    inMap.open('r')
+    featureCnt = len(inMap)
+    nonLines = featureCnt - inMap.number_of('lines')
+    limit = max(1, int(memory * 2**20 / extendlib.LINE_BYTES))
+    halo = 4.0 * maxlen
+    conn = scratchConnect()
+    conn.execute("CREATE TABLE dangles (cat INTEGER PRIMARY KEY, dkey INTEGER, partner INTEGER, "
+                 "fid INTEGER, dend INTEGER, ex DOUBLE PRECISION, ey DOUBLE PRECISION)")
+    extend = openExtend() if debug else None
+
+    box = inMap.bbox()
+
+    def count(x0, y0, x1, y1):
+# A box holding the whole map has every feature, without listing them
+        if x0 <= box.west and y0 <= box.south and x1 >= box.east and y1 >= box.north:
+            return featureCnt
+        found = inMap.find_by_bbox.geos(bbox=Bbox(north=y1, south=y0, east=x1, west=x0),
+                                        bboxlist_only=True)
+        return len(found) if found else 0
+
+# Start from as many tiles as an even spread of the features would need, so
+# no box list much bigger than a tile's is built
+    depth = int(math.ceil(math.log(max(featureCnt / float(limit), 1.0), 4)))
+    tiles = extendlib.quad_tiles(box.west, box.south, box.east, box.north, halo, count, limit,
+                                 depth) if featureCnt else []
+    grass.info("Searching {} features for dangles in tiles of up to {} features".format(featureCnt, limit))
+    dangleCnt = 0
+    for core in tiles:
+        prof.begin('read')
+        feats = inMap.find_by_bbox.geos(bbox=Bbox(north=core[3]+halo, south=core[1]-halo,
+                                                  east=core[2]+halo, west=core[0]-halo)) or []
+        feats = [ln for ln in feats if ln.gtype in (2, 4)]
+        xy, offsets = extendlib.pack_lines([ln.to_array() for ln in feats])
+        prof.end(len(feats), 'features')
+        dangles, extLen, best, partner = extendlib.extend_core(
+            core, xy, offsets, [ln.id for ln in feats], [-1 if ln.cat is None else ln.cat for ln in feats],
+            [ln.gtype == 2 for ln in feats], maxlen, scale, vlen, prof)
+        del feats, xy, offsets
+        prof.begin('write_dangles')
+        mods, nx, ny = extendlib.new_ends(dangles, best)
+        if extend is not None:
+            writeExtend(extend, dangles, extLen, best,   # 'ext' other_cat fixed below
+                        other=np.where(best['xtype'] == extendlib.EXT, partner, best['other']))
+            extend.table.conn.commit()
+        ex = np.full(len(dangles), np.nan)
+        ey = np.full(len(dangles), np.nan)
+        ex[mods] = nx
+        ey[mods] = ny
+        key = dangles['line']*2 + dangles['dend']
+        rows = [(dangleCnt+i+1, int(key[i]), int(partner[i]), int(dangles['line'][i]), int(dangles['dend'][i]),
+                 None if np.isnan(ex[i]) else float(ex[i]), None if np.isnan(ey[i]) else float(ey[i]))
+                for i in range(len(dangles))]
+        dangleCnt = dangleCnt + len(dangles)
+        conn.executemany("INSERT INTO dangles VALUES (?,?,?,?,?,?,?)", rows)
+        conn.commit()
+        prof.end(len(dangles), 'dangles')
+    inMap.close()
+    grass.info("{} dangle nodes found".format(dangleCnt))
+    if extend is not None:
+        with prof.stage('update_extend', dangleCnt, 'dangles'):
+            extend.close(build=True, release=True)
+# Extensions meeting another extension - its dangle key to its extend cat
+            conn.execute("CREATE INDEX idx_dkey ON dangles (dkey)")
+            conn.execute("UPDATE extend SET other_cat = (SELECT d2.cat FROM dangles d1 JOIN dangles d2 ON d1.partner=d2.dkey "
+                         "WHERE d1.cat=extend.cat) WHERE xtype='ext'")
+            conn.commit()
+    if debug:
+        with prof.stage('chosen_map'):
+            chosenMap()
+    with prof.stage('copy'):
+        map_out = outputMap(map, map_out, allowOverwrite)
+    if not map_out:
+        return 1
+    modCnt = conn.execute("SELECT count(*), count(DISTINCT fid) FROM dangles WHERE ex IS NOT NULL").fetchone()
+    grass.info("Extending {} dangles on {} lines".format(*modCnt))
+    with prof.stage('rewrite', modCnt[1], 'lines'):
+        cur = conn.execute("SELECT fid, dend, ex, ey FROM dangles WHERE ex IS NOT NULL ORDER BY fid")
+        rewriteLines(map_out, ((fid, [row[1:] for row in rows]) for fid, rows in groupby(cur, key=lambda row: row[0])),
+                     modCnt[1])
+    with prof.stage('remove', nonLines, 'features'):
+        removeNonLines(map_out, nonLines, featureCnt+modCnt[1])
+    grass.message("v.extendlines completing")
+    if debug:
+        keepScratch()
+    else:
+        cleanup()
+    return 0
+
+def extendIncremental(map, map_out, state, run, old, xy, offsets, fids, cats, isLine, hashes, boxes,
+                      maxlen, scale, vlen, prof):
 #
-# Now second self intersect table
+# Redo the dangles within 4 x maxlen of features added, changed or removed
+# since the run saved in old, and patch map_out to match. Features are
+# matched on (cat, geometry hash, is line); lines on their (unique) cat.
 #
-    grass.info("Searching for intersects of potential extensions")
-    table_isectX = Table('isectX',
-                connection=sqlite3.connect(get_path(path)))
-    if table_isectX.exist():
-        table_isectX.drop(force=True)
-    run_command("v.distance",
-                flags = 'a',
-                overwrite = True,
+    prof.begin('diff')
+    oldKeys = set(zip(old['cat'].tolist(), old['hash'].tolist(), old['is_line'].tolist()))
+    newKeys = set(zip(cats.tolist(), hashes.tolist(), isLine.tolist()))
+    added = np.array([k not in oldKeys for k in zip(cats.tolist(), hashes.tolist(), isLine.tolist())], dtype=bool)
+    gone = np.array([k not in newKeys for k in zip(old['cat'].tolist(), old['hash'].tolist(),
+                                                   old['is_line'].tolist())], dtype=bool)
+    changes = np.vstack([boxes[added], old['box'][gone]])
+    prof.end(len(cats), 'features')
+    grass.info("{} features added or changed, {} changed or removed since the last run".format(
+        int(added.sum()), int(gone.sum())))
+    if len(changes) == 0:
+        grass.message("Nothing has changed, map {} is up to date".format(map_out))
+        return
+#
+# Search the dangles near the changes again. Dangles further away are
+# unaffected, so keep their earlier results.
+#
+    dangles, extLen, best, partner = extendlib.extend_near(changes, xy, offsets, fids, cats, isLine,
+                                                           maxlen, scale, vlen, prof)
+    mods, nx, ny = extendlib.new_ends(dangles, best)
+    ex = np.full(len(dangles), np.nan)
+    ey = np.full(len(dangles), np.nan)
+    ex[mods] = nx
+    ey[mods] = ny
+    key = dangles['cat']*2 + dangles['dend']
+    near = extendlib.near_boxes(changes, old['dx'], old['dy'], old['dx'], old['dy'], pad=4.0*maxlen)
+    before = {k: (x, y) for k, x, y in zip(old['dkey'][near].tolist(), old['ex'][near].tolist(),
+                                           old['ey'][near].tolist())}
+    after = {k: (x, y) for k, x, y in zip(key.tolist(), ex.tolist(), ey.tolist())}
+# Lines to write again; new ends compared as text so unextended (nan) ends match
+    lineCat = dict(zip(cats[isLine].tolist(), fids[isLine].tolist()))
+    patch = set(cats[added & isLine].tolist())
+    patch.update(k // 2 for k in set(before) | set(after) if repr(before.get(k)) != repr(after.get(k)))
+    patch.intersection_update(lineCat)
+    removed = set(old['cat'][gone & old['is_line']].tolist()).difference(lineCat)
+    dkey = np.concatenate([old['dkey'][~near], key])
+    dx = np.concatenate([old['dx'][~near], dangles['x']])
+    dy = np.concatenate([old['dy'][~near], dangles['y']])
+    ex = np.concatenate([old['ex'][~near], ex])
+    ey = np.concatenate([old['ey'][~near], ey])
+    ends = {}
+    for k in np.flatnonzero(np.isin(dkey // 2, list(patch)) & ~np.isnan(ex)):
+        ends.setdefault(int(dkey[k] // 2), []).append((int(dkey[k] % 2), float(ex[k]), float(ey[k])))
+    grass.info("Patching {} lines and removing {} from {}".format(len(patch), len(removed), map_out))
+    oldLine = old['is_line'] & (old['out_fid'] > 0)
+    outFid = dict(zip(old['cat'][oldLine].tolist(), old['out_fid'][oldLine].tolist()))
+    with prof.stage('patch', len(patch) + len(removed), 'lines'):
+        patchLines(map, map_out, ((lineCat[c], ends.get(c, [])) for c in sorted(patch)), removed, outFid)
+    saveState(state, run, cats, isLine, hashes, boxes,
+              np.array([outFid.get(c, -1) if ok else -1 for c, ok in zip(cats.tolist(), isLine.tolist())],
+                       dtype=np.int64), dkey, dx, dy, ex, ey)
+
+def mapStamp(map):
+#
+# Identifies the current content of map - its full name, and the modification
+# time and size of its coordinate file, which every edit rewrites
+#
+    found = grass.find_file(map, element='vector')
+    coor = os.stat(os.path.join(found['file'], 'coor'))
+    return "{} {} {}".format(found['fullname'], coor.st_mtime_ns, coor.st_size)
+
+def loadState(state, run):
+#
+# The state saved by an earlier run with the same maps and settings, or
+# None if there is none to build on
+#
+    if not os.path.exists(state):
+        return None
+    with np.load(state) as saved:
+        old = dict(saved)
+    if 'out_fid' not in old:
+        grass.warning("State {} is from an older version, redoing the whole map".format(state))
+        return None
+    if any(str(old['run_' + k]) != str(run[k]) for k in ('map', 'map_out', 'maxlen', 'scale')):
+        grass.warning("State {} is from another map or settings, redoing the whole map".format(state))
+        return None
+    if not grass.find_file(run['map_out'], element='vector')['file']:
+        grass.warning("Map {} from state {} not found, redoing the whole map".format(run['map_out'], state))
+        return None
+    return old
+
+def saveState(state, run, cats, isLine, hashes, boxes, outFid, dkey, dx, dy, ex, ey):
+#
+# Per feature cat, geometry hash (extendlib.line_hashes()), extent and feature
+# id in map_out (-1 if not a line), and per dangle key (cat*2+dend) its end
+# and new end (nan if not extended), for the next run to compare
+#
+    with open(state, 'wb') as fh:   # A file object stops numpy adding .npz
+        np.savez(fh, cat=cats, is_line=isLine, hash=hashes, box=boxes, out_fid=outFid,
+                 dkey=dkey, dx=dx, dy=dy, ex=ex, ey=ey,
+                 **{'run_' + k: str(run[k]) for k in ('map', 'map_out', 'maxlen', 'scale')})
+
+def patchLines(map, map_out, lineMods, removed, outFid):
+#
+# Write lines of map, with any new ends, over those with the same cat in
+# map_out (or add them), and delete the lines with cats in removed.
+# lineMods gives (feature id in map, [(dend, x, y), ...]) for each. outFid
+# maps the cat of each line to its feature id in map_out, as the last run
+# saved it, and is updated in place to match.
+#
+    outMap = VectorTopo(map_out)
+    outMap.open('rw', tab_name = map_out)
+    for c in removed:
+        if c in outFid:
+            outMap.delete(outFid.pop(c))
+    inMap = VectorTopo(map)
+    inMap.open('r')
+    for fid, ends in lineMods:
+        ln = addEnds(inMap.read(fid), ends)
+        if ln.cat in outFid:
+            outFid[ln.cat] = rewriteLine(outMap, outFid[ln.cat], ln)
+        else:   # Written as is, keeping its cat
+            outFid[ln.cat] = libvect.Vect_write_line(outMap.c_mapinfo, ln.gtype, ln.c_points, ln.c_cats)
+    inMap.close()
+    outMap.close(build=True, release=True)
+
+def distanceTable(from_map, to_map, table):
+#
+# All lines of to_map touching each line of from_map (v.distance -a dmax=0),
+# loaded into table in the scratch database. v.distance can only create its
+# tables in the mapset database, so its printed output is used instead. The
+# output is read in full before taking the connection, so two searches can
+# run at once. Returns the number of rows loaded; a failed v.distance raises
+# CalledModuleError rather than loading what it printed before failing.
+#
+    conn = scratchConnect()
+    proc = grass.pipe_command("v.distance",
+                flags = 'pa',
                 quiet = True,
-                from_ = "extend",
+                from_ = from_map,
                 from_type = "line",
-                to = "extend", 
+                to = to_map,
                 to_type = "line",
                 dmax = "0",
                 upload = "cat,dist,to_x,to_y",
                 column = "near_cat,dist,nx,ny",
-                table = "isectX")
-# Obviously all extensions will intersect with themself, so remove those "intersects"
-    run_command("db.execute",
-                sql = "DELETE FROM isectX WHERE from_cat = near_cat",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    run_command("db.execute",
-                sql = "ALTER TABLE isectX ADD ntype VARCHAR",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    run_command("db.execute",
-                sql = "UPDATE isectX SET ntype = 'ext' ",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
+                separator = "pipe")
+    rows = (line.decode().strip().split('|') for line in proc.stdout)
+    next(rows, None)   # Header
+    rows = [row for row in rows if len(row) == 5]
+    if proc.wait() != 0:
+        raise CalledModuleError(module="v.distance", code="from={} to={}".format(from_map, to_map),
+                                returncode=proc.returncode)
+    with scratch['lock'], conn:
+        conn.execute("CREATE TABLE {} (from_cat INTEGER, near_cat INTEGER, dist DOUBLE PRECISION, "
+                     "nx DOUBLE PRECISION, ny DOUBLE PRECISION)".format(table))
+        conn.executemany("INSERT INTO {} VALUES (?,?,?,?,?)".format(table), rows)
+    return len(rows)
+
+def isectOrig():
 #
-# Combine the two tables and add a few more attributes
-#				
-    run_command("db.execute",
-                sql = "INSERT INTO isectIn SELECT * FROM isectX",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    cols_isectIn = Columns('isectIn',
-                connection=sqlite3.connect(get_path(path)))
-    cols_isectIn.add(['from_x'], ['DOUBLE PRECISION'])
-    cols_isectIn.add(['from_y'], ['DOUBLE PRECISION'])
-    cols_isectIn.add(['ext_len'], ['DOUBLE PRECISION'])
-# Get starting coordinate at the end of the dangle
-    run_command("db.execute",
-                sql = "UPDATE isectIn SET from_x = (SELECT extend.orgx FROM extend WHERE from_cat=extend.cat)",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    run_command("db.execute",
-                sql = "UPDATE isectIn SET from_y = (SELECT extend.orgy FROM extend WHERE from_cat=extend.cat)",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    table_isectIn.conn.commit()
-# For each intersect point, calculate the distance along extension line from end of dangle
-# Would be nicer to do this in the database but SQLite dosen't support sqrt or exponents
-    grass.info("Calculating distances of intersects along potential extensions")
-    cur=table_isectIn.execute(sql_code="SELECT rowid, from_x, from_y, nx, ny FROM isectIn")
-    for row in cur.fetchall():
-        rowid,fx,fy,nx,ny = row
-        x_len=math.sqrt((fx-nx)**2+(fy-ny)**2)
-        sqlStr="UPDATE isectIn SET ext_len={:.8f} WHERE rowid={:d}".format(x_len,rowid)
-        table_isectIn.execute(sql_code=sqlStr)
-    grass.verbose("Ready to commit isectIn changes")
-    table_isectIn.conn.commit()
+# Each extension will have touched the dangle it comes from, so remove those
+# touches from isectIn
+#
+    conn = scratchConnect()
+    with scratch['lock'], conn:
+        conn.execute("DELETE FROM isectIn WHERE rowid IN (SELECT isectIn.rowid FROM isectIn INNER JOIN extend ON from_cat=cat WHERE near_cat=parent)")
+        conn.execute("ALTER TABLE isectIn ADD ntype VARCHAR")
+        conn.execute("UPDATE isectIn SET ntype = 'orig' ")
+
+def isectExt():
+#
+# Obviously all extensions will intersect with themself, so remove those
+# "intersects" from isectX
+#
+    conn = scratchConnect()
+    with scratch['lock'], conn:
+        conn.execute("DELETE FROM isectX WHERE from_cat = near_cat")
+        conn.execute("ALTER TABLE isectX ADD ntype VARCHAR")
+        conn.execute("UPDATE isectX SET ntype = 'ext' ")
+
+def isectLengths(conn):
+#
+# Combine the two tables into isectIn, with the distance of each intersect
+# along its extension from the end of the dangle. Returns the rows left.
+#
+    with scratch['lock']:
+        with conn:
+            conn.execute("INSERT INTO isectIn SELECT * FROM isectX")
+        cols_isectIn = Columns('isectIn',
+                    connection=conn)
+        cols_isectIn.add(['from_x'], ['DOUBLE PRECISION'])
+        cols_isectIn.add(['from_y'], ['DOUBLE PRECISION'])
+        cols_isectIn.add(['ext_len'], ['DOUBLE PRECISION'])
+# For each intersect point, the distance along extension line from the end of
+# its dangle (sqrt is registered by scratchConnect(), SQLite has none)
+        grass.info("Calculating distances of intersects along potential extensions")
+        with conn:
+            conn.execute("UPDATE isectIn SET (from_x, from_y) = (SELECT extend.orgx, extend.orgy FROM extend WHERE from_cat=extend.cat)")
+            conn.execute("UPDATE isectIn SET ext_len = round(sqrt((from_x-nx)*(from_x-nx)+(from_y-ny)*(from_y-ny)), 8)")
 # Remove any zero distance from end of their dangle.
 # This happens when another extension intersects exactly at that point
-    run_command("db.execute",
-                sql = "DELETE FROM isectIn WHERE ext_len = 0.0",
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    table_isectIn.conn.commit()
-
-# Go through the extensions and find the intersect closest to each origin.
-    grass.info("Searching for closest intersect for each potential extension")
-
-# db.execute sql="ALTER TABLE extend_t1 ADD COLUMN bst INTEGER"
-# db.execute sql="ALTER TABLE extend_t1 ADD COLUMN nrx DOUBLE PRECISION"
-# db.execute sql="ALTER TABLE extend_t1 ADD COLUMN nry DOUBLE PRECISION"
-# db.execute sql="ALTER TABLE extend_t1 ADD COLUMN ocat TEXT"
-#    run_command("db.execute", 
-#                sql = "INSERT OR REPLACE INTO extend_t1 (bst, nrx, nry, ocat) VALUES ((SELECT isectIn.rowid, ext_len, nx, ny, near_cat, ntype FROM isectIn WHERE from_cat=extend_t1.cat ORDER BY ext_len ASC LIMIT 1))",
-#               driver = "sqlite",
-#               database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-
-    grass.verbose("CREATE index")
-    run_command("db.execute",
-                sql = "CREATE INDEX idx_from_cat ON isectIn (from_cat)",
-                driver = "sqlite", database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    grass.verbose("UPDATE best_xid")
-    run_command("db.execute",
-                sql = "UPDATE extend SET best_xid = (SELECT isectIn.rowid FROM isectIn WHERE from_cat=extend.cat ORDER BY ext_len ASC LIMIT 1)",
-                driver = "sqlite", database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    grass.verbose("UPDATE x_len")
-    run_command("db.execute",
-                sql = "UPDATE extend SET x_len = (SELECT ext_len FROM isectIn WHERE from_cat=extend.cat ORDER BY ext_len ASC LIMIT 1)",
-                driver = "sqlite", database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    grass.verbose("UPDATE near_x")
-    run_command("db.execute",
-                sql = "UPDATE extend SET near_x = (SELECT nx FROM isectIn WHERE from_cat=extend.cat ORDER BY ext_len ASC LIMIT 1)",
-                driver = "sqlite", database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    grass.verbose("UPDATE near_y")
-    run_command("db.execute",
-                sql = "UPDATE extend SET near_y = (SELECT ny FROM isectIn WHERE from_cat=extend.cat ORDER BY ext_len ASC LIMIT 1)",
-                driver = "sqlite", database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    grass.verbose("UPDATE other_cat")
-    run_command("db.execute",
-                sql = "UPDATE extend SET other_cat = (SELECT near_cat FROM isectIn WHERE from_cat=extend.cat ORDER BY ext_len ASC LIMIT 1)",
-                driver = "sqlite", database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    grass.verbose("UPDATE xtype")
-    run_command("db.execute",
-                sql = "UPDATE extend SET xtype = (SELECT ntype FROM isectIn WHERE from_cat=extend.cat ORDER BY ext_len ASC LIMIT 1)",
-                driver = "sqlite", database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    grass.verbose("DROP index")
-    run_command("db.execute", sql = "DROP INDEX idx_from_cat",
-                driver = "sqlite", database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    grass.verbose("CREATE index on near_cat")
-    run_command("db.execute",
-                sql = "CREATE INDEX idx_near_cat ON isectIn (near_cat)",
-                driver = "sqlite", database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-
-
-    quiet=table_isectIn.filters.select('rowid','ext_len','nx','ny','near_cat','ntype')
-#    quiet=table_isectIn.filters.order_by(['ext_len ASC'])
-    quiet=table_isectIn.filters.order_by('ext_len ASC')
-    quiet=table_isectIn.filters.limit(1)
-    table_extend = Table('extend',
-                connection=sqlite3.connect(get_path(path)))
-
-# Code below was relplaced by commands above untill memory problem can be sorted
-#    table_extend.filters.select('cat')
-#    cur=table_extend.execute()
-#    updateCnt = 0
-#    for row in cur.fetchall():
-#        cat, = row
-#        quiet=table_isectIn.filters.where('from_cat={:d}'.format(cat))
-
-##SELECT rowid, ext_len, nx, ny, near_cat, ntype FROM isectIn WHERE from_cat=32734 ORDER BY ext_len ASC LIMIT 1
-
-#        x_sect=table_isectIn.execute().fetchone()
-#        if x_sect is not None:
-#            x_rowid, ext_len, nx, ny, other_cat, ntype = x_sect
-#            sqlStr="UPDATE extend SET best_xid={:d}, x_len={:.8f}, near_x={:.8f}, near_y={:.8f}, other_cat={:d}, xtype='{}' WHERE cat={:d}".format(x_rowid, ext_len, nx, ny, other_cat, ntype, cat) 
-#            table_extend.execute(sql_code=sqlStr)
-## Try periodic commit to avoide crash! 
-#            updateCnt = (updateCnt + 1) % 10000
-#            if updateCnt == 0:
-#              table_extend.conn.commit()
-    grass.verbose("Ready to commit extend changes")
-    table_extend.conn.commit()
-#
-# There may be extensions that crossed, and that intersection chosen by one but 
-# not "recripricated" by the other.
-# Need to remove those possibilities and allow the jilted extension to re-search.
-#
-    grass.verbose("Deleting intersects already resolved")
-    run_command("db.execute",
-                sql = "DELETE FROM isectIn WHERE rowid IN (SELECT isectIn.rowid FROM isectIn JOIN extend ON near_cat=cat WHERE ntype='ext' AND xtype!='null')",  #"AND from_cat!=other_cat" no second chance!
-                driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db")
-    table_isectIn.conn.commit()
-    grass.verbose("Deleting complete")
-
-# To find the jilted - need a copy of extensions that have found an 
-# intersection (won't overwrite so drop first)
-    grass.verbose("Re-searching for mis-matched intersects between potential extensions")
-    table_imatch = Table('imatch',
-                connection=sqlite3.connect(get_path(path)))
-    if table_imatch.exist():
-        table_imatch.drop(force=True)
-    wvar="xtype!='null'"
-    run_command("db.copy",
-	        overwrite = True,
-                quiet = True,
-                from_driver = "sqlite",
-                from_database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db",
-                from_table = "extend",
-                to_driver = "sqlite",
-                to_database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db",
-                to_table = "imatch",
-                where = wvar)
-# Memory problems?
-    if gc.isenabled():
-      grass.verbose("Garbage collection enabled - forcing gc cycle")
-      gc.collect()
-    else:
-      grass.verbose("Garbage collection not enabled")
-# Ensure tables are commited
-    table_extend.conn.commit()
-    table_imatch.conn.commit()
-    table_isectIn.conn.commit()
-# Identify the jilted
-    sqlStr = "SELECT extend.cat FROM extend JOIN imatch ON extend.other_cat=imatch.cat WHERE extend.xtype='ext' and extend.cat!=imatch.other_cat"
-    cur=table_extend.execute(sql_code=sqlStr)
-    updateCnt = 0
-    for row in cur.fetchall():
-        cat, = row
-        grass.verbose("Reworking extend.cat={}".format(cat))
-        quiet=table_isectIn.filters.where('from_cat={:d}'.format(cat))
-        #print("SQL: {}".format(table_isectIn.filters.get_sql()))
-        x_sect=table_isectIn.execute().fetchone()  ## Problem here under modules
-        if x_sect is None:
-            sqlStr="UPDATE extend SET best_xid=0, x_len=search_len, near_x=0, near_y=0, other_cat=0, xtype='null' WHERE cat={:d}".format(cat)
+            conn.execute("DELETE FROM isectIn WHERE ext_len = 0.0")
+        return conn.execute("SELECT count(*) FROM isectIn").fetchone()[0]
+
+def profileReport(prof, profile_out, run):
+#
+# Print the per-stage table, and write it with the run's settings to
+# profile_out as JSON if given
+#
+    if prof is extendprof.NOPROF:
+        return
+    grass.message("Stage profile:\n" + prof.summary())
+    if profile_out:
+        prof.write(profile_out, **run)
+        grass.info("Stage profile written to {}".format(profile_out))
+
+def openExtend():
+#
+# Open the scratch map "extend" for writeExtend(), with table extend in the
+# scratch database
+#
+    extend = VectorTopo(scratchMap('extend'))
+    extend.open('w', tab_name = 'extend', tab_cols = EXTEND_COLS, link_db = scratch['db'])
+    scratchConnect(extend.table.conn)
+    return extend
+
+def writeExtendMap(dangles, extLen, best=None):
+#
+# Write all the potential extensions to the scratch map "extend" in one go,
+# returning its name
+#
+    extend = openExtend()
+    writeExtend(extend, dangles, extLen, best)
+    extend.table.conn.commit()
+    extend.close(build=True, release=True)
+    return extend.name
+
+def writeExtend(extend, dangles, extLen, best=None, other=None):
+#
+# Write an extension line for each dangle to the extend map, with its chosen
+# intersect if known. other gives each choice's other_cat: the cat of the
+# line met, or for 'ext' choices the extend cat of the extension met, by
+# default the dangle index+1.
+#
+    if other is None and best is not None:
+        other = np.where(best['xtype'] == extendlib.EXT, best['other']+1, best['other'])
+    for i, (dg, sLen) in enumerate(zip(dangles, extLen)):
+        sx, sy, endaz = float(dg['x']), float(dg['y']), float(dg['az'])
+        extLine = geo.Line([(sx,sy),(sLen*math.cos(endaz)+sx,sLen*math.sin(endaz)+sy)])
+        if best is None or best['xtype'][i] == extendlib.NULL:
+            attrs = (int(dg['cat']),extendlib.DENDS[dg['dend']],sx,sy,float(sLen),endaz,0,0,0,0,'null',float(sLen))
         else:
-            x_rowid, ext_len, nx, ny, other_cat, ntype = x_sect
-            sqlStr="UPDATE extend SET best_xid={:d}, x_len={:.8f}, near_x={:.8f}, near_y={:.8f}, other_cat={:d}, xtype='{}' WHERE cat={:d}".format(x_rowid, ext_len, nx, ny, other_cat, ntype, cat) 
-        table_extend.execute(sql_code=sqlStr)
-## Try periodic commit to avoide crash! 
-        updateCnt = (updateCnt + 1) % 100
-        if (updateCnt == 0): # or (cat == 750483):
-            grass.verbose("XXXXXXXXXXX Committing table_extend XXXXXXXXXXXXXXXXXXXXXX")
-            table_extend.conn.commit()
-
-    grass.verbose("Committing adjustments to table extend")
-    table_extend.conn.commit()
+            bst = best[i]
+            attrs = (int(dg['cat']),extendlib.DENDS[dg['dend']],sx,sy,float(sLen),endaz,int(bst['xid']),
+                     float(bst['x']),float(bst['y']),int(other[i]),extendlib.XTYPES[bst['xtype']],float(bst['dist']))
+        quiet=extend.write(extLine, attrs)
+
+def chosenMap():
 #
-# For debugging, create a map with the chosen intersect points
+# For debugging, a map "chosen" of the intersect points chosen in table extend
 #
-    if debug:
-        wvar="xtype!='null' AND x_len!=0"
-#        print(wvar)
-        run_command("v.in.db",
+    wvar="xtype!='null' AND x_len!=0"
+    run_command("v.in.db",
                 overwrite = True,
                 quiet = True,
                 table = "extend",
                 driver = "sqlite",
-                database = "$GISDBASE/$LOCATION_NAME/$MAPSET/sqlite/sqlite.db",
+                database = scratch['db'],
                 x = "near_x",
                 y = "near_y",
                 key = "cat",
                 where = wvar,
-                output = "chosen")
+                output = scratchMap('chosen'))
+
+def outputMap(map, map_out, allowOverwrite):
 #
-# Finally adjust the dangle lines in input map - use a copy (map_out) if requested
+# Copy map to map_out if requested, otherwise the input map itself is modified.
+# Returns the name of the map to modify, or None if not allowed.
 #
     if map_out:
         run_command("g.copy",
@@ -433,62 +1346,128 @@ def extendLine(map, map_out, maxlen=200, scale=0.5, debug=False, verbose=1):
             map_out = map
         else:
             grass.error("Use switch --o to modifying input vector map ({})".format(map))
-            return 1
-#
-# Get info for lines that need extending
-    table_extend.filters.select('parent, dend, near_x, near_y, search_az, xtype')
-    table_extend.filters.where("xtype!='null'")
-    extLines = table_extend.execute().fetchall()
-    cat_mods=[ext[0] for ext in extLines]
-    tickLen=len(cat_mods)
-    grass.info("Extending {} dangles".format(tickLen))
+            return None
+    return map_out
+
+def extendOutput(map_out, dangles, best, nonLines, featureCnt, prof):
+#
+# Extend the dangles of map_out (a copy of the input map or the map itself)
+# to their chosen intersects and remove all but lines. Returns new_ends()
+# plus the new feature id of each rewritten line, by its old one.
+#
+# Gather the new end points of each line that needs extending, by feature id
+# (g.copy keeps them), so both ends of a line go into one rewrite
+    mods, nx, ny = extendlib.new_ends(dangles, best)
+    lineMods = {}
+    for fid, dend, x, y in zip(dangles['line'][mods].tolist(), dangles['dend'][mods].tolist(),
+                               nx.tolist(), ny.tolist()):
+        lineMods.setdefault(fid, []).append((dend, x, y))
+    grass.info("Extending {} dangles on {} lines".format(len(mods), len(lineMods)))
+    with prof.stage('rewrite', len(lineMods), 'lines'):
+        newFid = rewriteLines(map_out, ((fid, lineMods[fid]) for fid in sorted(lineMods)), len(lineMods))
+    with prof.stage('remove', nonLines, 'features'):
+        removeNonLines(map_out, nonLines, featureCnt+len(lineMods))  # Rewrites take new ids
+    return mods, nx, ny, newFid
+
+def snapOutput(map_out, xy, offsets, fids, cats, isLine, dangles, best, nonLines, featureCnt, prof):
+#
+# As extendOutput(), but each extension ends exactly on its hit point, where
+# the line it meets is split, so they are noded without a v.clean pass.
+# Lines are rewritten from their 2D coordinates.
+#
+    fids = np.asarray(fids, dtype=np.int64)
+    with prof.stage('snap', len(dangles), 'dangles'):
+        changed, coords = extendlib.snap_lines(xy, offsets, fids, cats, dangles, best,
+                                               np.asarray(isLine, dtype=bool))
+    added = sum(len(parts) - 1 for parts in coords)
+    grass.info("Snapping {} dangles, changing {} lines and adding {} from splits".format(
+        int((best['xtype'] != extendlib.NULL).sum()), len(changed), added))
+    with prof.stage('rewrite', len(changed), 'lines'):
+        splitLines(map_out, zip(fids[changed].tolist(), coords), len(changed))
+    with prof.stage('remove', nonLines, 'features'):
+        removeNonLines(map_out, nonLines, featureCnt+len(changed)+added)  # Rewrites take new ids
+
+def splitLines(map_out, lineMods, tickLen):
+#
+# As rewriteLines(), but lineMods gives (feature id, [coords, ...]) for each
+# line: it is rewritten with the first (n, 2) coordinates, and the others are
+# written as new lines with the same cats.
+#
     ticker=0
     grass.message("Percent complete...")
+    inMap=VectorTopo(map_out)
+    inMap.open('rw', tab_name = map_out)
+    for fid, parts in lineMods:
+        ticker = (ticker + 1)
+        grass.percent(ticker,tickLen,5)
+        ln = setCoords(inMap.read(fid), parts[0])
+        quiet=inMap.rewrite(fid, ln)
+        for c in parts[1:]:
+            ln = setCoords(ln, c)
+            libvect.Vect_write_line(inMap.c_mapinfo, ln.gtype, ln.c_points, ln.c_cats)
+    inMap.close(build=True, release=True)
 
-# Open up the map_out copy (or the original) and work through looking for lines that need modifying
+def rewriteLines(map_out, lineMods, tickLen, edit=None):
+#
+# Open up map_out and rewrite just the lines that need modifying.
+# lineMods gives (feature id, [(dend, x, y), ...]) for each, in feature id order,
+# applied by addEnds() or by edit(line, mods) if given. Rewrites take new ids;
+# returns the new feature id of each line, by its old one.
+#
+    ticker=0
+    grass.message("Percent complete...")
     inMap=VectorTopo(map_out)
     inMap.open('rw', tab_name = map_out)
+    newFid = {}
+    for fid, ends in lineMods:
+        ticker = (ticker + 1)
+        grass.percent(ticker,tickLen,5)
+        ln = (edit or addEnds)(inMap.read(fid), ends)
+        newFid[fid] = rewriteLine(inMap, fid, ln)
+    inMap.close(build=True, release=True)
+    return newFid
 
-    for ln_idx in range(len(inMap)):
-        ln = inMap.read(ln_idx+1)
-        if ln.gtype==2: # Only process lines
-            while ln.cat in cat_mods:      # Note: could be 'head' and 'tail'
-                ticker = (ticker + 1)
-                grass.percent(ticker,tickLen,5)
-                cat_idx=cat_mods.index(ln.cat)
-                cat, dend, nx, ny, endaz, xtype  = extLines.pop(cat_idx)
-                dump = cat_mods.pop(cat_idx)
-                if xtype == 'orig':  # Overshoot by 0.1 as break lines is unreliable
-                  nx = nx + 0.1*math.cos(endaz)
-                  ny = ny + 0.1*math.sin(endaz)
-                newEnd=geo.Point(x=nx, y=ny, z=None)
-                if dend == 'head':
-                    ln.insert(0,newEnd)
-                else:      # 'tail'
-                    ln.append(newEnd)
-                quiet=inMap.rewrite(ln_idx+1,ln)
-        else:
-            quite=inMap.delete(ln_idx+1)
-## Try periodic commit and garbage collection to avoide crash! 
-        if (ln_idx % 1000) == 0:
-#           inMap.table.conn.commit()  - no such thing - Why??
-            if gc.isenabled():
-              quiet = gc.collect()
+def rewriteLine(inMap, fid, ln):
+#
+# Rewrite feature fid of the open map inMap as line ln, returning its new id
+#
+    new = libvect.Vect_rewrite_line(inMap.c_mapinfo, fid, ln.gtype, ln.c_points, ln.c_cats)
+    if new < 0:
+        grass.fatal("Unable to rewrite feature {} of map {}".format(fid, inMap.name))
+    return new
 
-    inMap.close(build=True, release=True)
-    grass.message("v.extendlines completing")
+def addEnds(ln, ends):
 #
-# Clean up temporary tables and maps                    
+# Add the new end points [(dend, x, y), ...] to line ln
 #
-    if not debug:
-        table_isectIn.drop(force=True)
-        table_isectX.drop(force=True)
-        table_imatch.drop(force=True)
-        extend.remove()
-        chosen=VectorTopo('chosen')
-        if chosen.exist():
-            chosen.remove()
-    return 0
+    for dend, x, y in ends:   # Note: could be 'head' and 'tail'
+        newEnd=geo.Point(x=x, y=y, z=None)
+        if dend == extendlib.HEAD:
+            ln.insert(0,newEnd)
+        else:      # 'tail'
+            ln.append(newEnd)
+    return ln
+
+def setCoords(ln, coords):
+#
+# Replace the points of line ln with coords, an (n, 2) array
+#
+    ln.reset()
+    ln.extend([geo.Point(x=x, y=y, z=None) for x, y in coords.tolist()])
+    return ln
+
+def removeNonLines(map_out, nonLines, maxId):
+#
+# Only lines are kept, remove everything else in one go
+#
+    if nonLines > 0:
+        grass.info("Removing {} features that are not lines".format(nonLines))
+        run_command("v.edit",
+                    quiet = True,
+                    map = map_out,
+                    tool = "delete",
+                    type = "point,centroid,boundary,face,kernel",
+                    ids = "1-{}".format(maxId))
 
 if __name__ == "__main__":
     options, flags = grass.parser()
@@ -497,4 +1476,44 @@ if __name__ == "__main__":
         options['maxlen'] = 200
     if not options['scale']:
         options['scale'] = 0.5
-    sys.exit(extendLine(map=options['map'], map_out=options['map_out'], maxlen=options['maxlen'], scale=options['scale'], debug=flags['d']))
+    if not options['method']:
+        options['method'] = 'engine'
+    if not options['scan']:
+        options['scan'] = 'array'
+    if not options['nprocs']:
+        options['nprocs'] = 1
+    if not options['memory']:
+        options['memory'] = 300
+    if not options['passes']:
+        options['passes'] = 1
+    if not options['jobs']:
+        options['jobs'] = 2
+    maxlens = [float(v) for v in str(options['maxlen']).split(',')]
+    scales = [float(v) for v in str(options['scale']).split(',')]
+    if options['input']:
+        if len(maxlens) > 1 or len(scales) > 1:
+            grass.fatal("A sweep over several maxlen or scale values takes a map")
+        if flags['s'] or options['state'] or options['index'] or options['method'] == 'vdistance':
+            grass.warning("OGR input always runs in memory with method=engine, ignoring -s, state and index")
+        sys.exit(extendOgr(options['input'], options['layer'] or None, options['output'],
+                           options['output_layer'] or None, options['format'] or 'GPKG',
+                           maxlen=maxlens[0], scale=scales[0], nprocs=int(options['nprocs']),
+                           passes=int(options['passes']), snap=flags['n'],
+                           profile=flags['p'], profile_out=options['profile'] or None))
+    if options['maps'] or options['pattern']:
+        if len(maxlens) > 1 or len(scales) > 1:
+            grass.fatal("A sweep over several maxlen or scale values takes a single map")
+        if options['state']:
+            grass.warning("state is ignored for a batch")
+        maps = options['maps'].split(',') if options['maps'] else grass.list_strings('vector', pattern=options['pattern'])
+        if not maps:
+            grass.fatal("No vector maps match pattern {}".format(options['pattern']))
+        sys.exit(extendBatch(maps, options['suffix'], int(options['nprocs']),
+                             maxlen=maxlens[0], scale=scales[0], debug=flags['d'], method=options['method'],
+                             scan=options['scan'], stream=flags['s'], memory=float(options['memory']),
+                             profile=flags['p'], index=options['index'] or None, passes=int(options['passes']), snap=flags['n'], jobs=int(options['jobs'])))
+    if len(maxlens) > 1 or len(scales) > 1:
+        sys.exit(extendSweep(map=options['map'], map_out=options['map_out'], maxlens=maxlens, scales=scales,
+                             index=options['index'] or None, stats=options['stats'] or None,
+                             profile=flags['p'], profile_out=options['profile'] or None))
+    sys.exit(extendLine(map=options['map'], map_out=options['map_out'], maxlen=maxlens[0], scale=scales[0], debug=flags['d'], method=options['method'], scan=options['scan'], nprocs=int(options['nprocs']), stream=flags['s'], memory=float(options['memory']), profile=flags['p'], profile_out=options['profile'] or None, state=options['state'] or None, index=options['index'] or None, passes=int(options['passes']), snap=flags['n'], jobs=int(options['jobs'])))